@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+benchmark_carta.py
+
+Mede, sem rede e sem Streamlit, o tempo e o pico de memória de cada etapa da carta
+(leitura da planilha, cache Parquet, índice de busca, facetas, preços, ordenação, modelo da carta,
+PDF e Excel) sobre catálogos sintéticos de 1k/10k/100k itens com fotos falsas.
+
+Os catálogos são gerados com semente fixa (distribuições de tipo/país/uva/preço tiradas do
+vinhos1.xls) e reaproveitados entre execuções em --dados. Cada etapa roda --repeticoes vezes
+(vale o menor tempo) e mais uma vez sob tracemalloc para o pico de memória do Python.
+O resultado vai em JSON para --saida e, se houver um resultado base (--base), sai a comparação
+etapa a etapa; regressões acima de --tolerancia fazem o script terminar com código 1.
+
+Exemplos:
+    python benchmark_carta.py --gravar-base
+    python benchmark_carta.py --tamanhos 1000,10000 --repeticoes 5
+    python benchmark_carta.py --base benchmarks/base.json --tolerancia 0.15
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+import carta_vinhos_p as cv
+
+BENCH_DIR = os.path.join(cv.BASE_DIR, "benchmarks")
+RESULTADO_VERSAO = 1
+RUIDO_SEGUNDOS = 0.005  # Diferenças menores que isso não contam como regressão
+
+# Distribuições observadas no vinhos1.xls
+TIPOS = {"Vinhos Tintos": 0.652, "Vinhos Brancos": 0.206, "Vinhos Rosés": 0.062, "Espumantes": 0.051,
+         "Frisantes": 0.015, "Fortificados": 0.011, "Vinhos Sobremesas": 0.004, "Licorosos": 0.001}
+PAISES = {"Chile": ["Valle de Colchagua", "Valle de Casablanca", "Vale Central", "Valle del Maipo"],
+          "Argentina": ["Mendoza", "Salta", "San Juan"],
+          "França": ["Languedoc-Roussillon", "Bordeaux", "Bourgogne", "Vallée du Rhône"],
+          "Portugal": ["Alentejo", "Douro", "Dão", "Vinho Verde"],
+          "Itália": ["Toscana", "Piemonte", "Puglia", "Veneto"],
+          "Brasil": ["Flores da Cunha", "Rio Grande do Sul", "Serra Gaúcha", "Vale do São Francisco"],
+          "Espanha": ["Rioja", "Ribera del Duero", "La Mancha"],
+          "Africa do Sul": ["Stellenbosch", "Western Cape"],
+          "Estados Unidos": ["California", "Washington"],
+          "Uruguai": ["Canelones"], "Alemanha": ["Mosel"], "Austrália": ["South Australia"]}
+PAISES_PESO = [0.204, 0.154, 0.15, 0.12, 0.118, 0.099, 0.093, 0.012, 0.012, 0.008, 0.012, 0.004]
+UVAS = {"Cabernet Sauvignon": 0.112, "Chardonnay": 0.076, "Malbec": 0.074, "Merlot": 0.07, "Sauvignon Blanc": 0.065,
+        "Tempranillo": 0.05, "Carmenére": 0.042, "Syrah": 0.042, "Pinot Noir": 0.041, "Sangiovese": 0.028,
+        "Touriga Nacional": 0.024, "Moscatel": 0.023, "Aragonez": 0.02, "Isabel": 0.016, "Tannat": 0.012,
+        "Riesling": 0.01, "Glera": 0.01, "Pinot Grigio": 0.01}
+CORPOS = ["Corpo Leve", "Corpo Médio", "Encorpado", "Robusto"]
+# Tabelas de preço em relação à preco1 (medianas do vinhos1.xls)
+TABELAS_RELATIVAS = {"preco38": 0.77, "preco39": 0.87, "preco2": 1.07, "preco15": 0.84, "preco55": 1.07, "preco63": 0.79}
+BUSCAS = ["cabernet", "reserva chile", "malbec mendoza", "tint", "zzz"]
+
+
+def _escolha(rng, opcoes, pesos, n):
+    pesos = np.asarray(pesos, dtype=float)
+    return np.asarray(opcoes, dtype=object)[rng.choice(len(opcoes), size=n, p=pesos / pesos.sum())]
+
+
+def gerar_catalogo(n, pasta, semente=42, fracao_fotos=0.6):
+    """
+    Planilha sintética com n itens (colunas do vinhos1.xls) e pasta de fotos falsas.
+    Devolve (caminho da planilha, pasta de imagens). As fotos são poucos JPEGs distintos ligados por hardlink.
+    """
+    rng = np.random.default_rng(semente)
+    os.makedirs(pasta, exist_ok=True)
+    cods = rng.choice(np.arange(100, 100 + n * 10), size=n, replace=False)
+    paises = _escolha(rng, list(PAISES), PAISES_PESO, n)
+    regioes = np.array([PAISES[p][i % len(PAISES[p])] for p, i in zip(paises, rng.integers(0, 12, n))], dtype=object)
+    uvas = [_escolha(rng, list(UVAS), list(UVAS.values()), n) for _ in range(3)]
+    uvas[1] = np.where(rng.random(n) < 0.32, uvas[1], "")
+    uvas[2] = np.where((uvas[1] != "") & (rng.random(n) < 0.55), uvas[2], "")
+    vinicolas = np.array([f"Bodega {i:04d}" for i in rng.integers(0, max(n // 8, 10), n)], dtype=object)
+    linhas = np.array(["Reserva", "Gran Reserva", "Clássico", "Seleção", "Terroir", ""], dtype=object)[rng.integers(0, 6, n)]
+    safras = rng.integers(2010, 2025, n)
+    descricao = [f"VH {v.upper()} {l.upper()} {u.upper()} {s} 750".replace("  ", " ")
+                 for v, l, u, s in zip(vinicolas, linhas, uvas[0], safras)]
+    preco1 = np.round(np.exp(rng.normal(np.log(92), 0.9, n)), 2)
+    df = pd.DataFrame({
+        "COD": cods, "DESCRICAO": descricao, "TIPO": _escolha(rng, list(TIPOS), list(TIPOS.values()), n),
+        "PAIS": paises, "REGIAO": regioes, "UVA1": uvas[0], "UVA2": uvas[1], "UVA3": uvas[2],
+        "VINICOLA": vinicolas, "CORPO_VINHO": _escolha(rng, CORPOS, [0.33, 0.37, 0.24, 0.06], n),
+        "AMADURECIMENTO": np.where(rng.random(n) < 0.35, "12 meses em barricas de carvalho", ""),
+        "PREMIACOES": np.where(rng.random(n) < 0.26, "- Descorchados: 90 pts", ""),
+        "PRECO1": preco1,
+    })
+    for col, rel in TABELAS_RELATIVAS.items():
+        valores = np.round(preco1 * rel * rng.normal(1.0, 0.03, n), 2)
+        df[col.upper()] = np.where(rng.random(n) < 0.1, np.nan, valores)
+    # Linhas vazias e tipos fora da lista fixa, como na planilha real
+    df.loc[rng.random(n) < 0.03, ["TIPO", "PAIS"]] = ""
+    df.loc[rng.random(n) < 0.01, "TIPO"] = "Sidra"
+
+    planilha = os.path.join(pasta, f"vinhos_sintetico_{n}.xlsx")
+    engine = "xlsxwriter" if cv.xlsxwriter is not None else "openpyxl"
+    df.to_excel(planilha, index=False, engine=engine)
+
+    imagens = os.path.join(pasta, f"imagens_{n}")
+    shutil.rmtree(imagens, ignore_errors=True)
+    os.makedirs(imagens)
+    modelos = []
+    for i in range(8):
+        path = os.path.join(imagens, f"_modelo{i}.jpg")
+        cor = tuple(int(c) for c in rng.integers(40, 220, 3))
+        Image.new("RGB", (600, 800), cor).save(path, "JPEG", quality=90)
+        modelos.append(path)
+    for i, cod in enumerate(cods[rng.random(n) < fracao_fotos]):
+        destino = os.path.join(imagens, f"{cod}.jpg")
+        try:
+            os.link(modelos[i % len(modelos)], destino)
+        except OSError:
+            shutil.copyfile(modelos[i % len(modelos)], destino)
+    return planilha, imagens
+
+
+def preparar_catalogo(n, dados, semente, regerar=False):
+    """Reaproveita a planilha/fotos de uma execução anterior com o mesmo tamanho e semente."""
+    pasta = os.path.join(dados, f"s{semente}")
+    planilha = os.path.join(pasta, f"vinhos_sintetico_{n}.xlsx")
+    imagens = os.path.join(pasta, f"imagens_{n}")
+    if regerar or not (os.path.exists(planilha) and os.path.isdir(imagens)):
+        inicio = time.perf_counter()
+        planilha, imagens = gerar_catalogo(n, pasta, semente)
+        print(f"  catálogo sintético de {n} itens gerado em {time.perf_counter() - inicio:.1f}s")
+    return planilha, imagens
+
+
+def medir(funcao, repeticoes):
+    """(menor tempo, mediana, pico tracemalloc em MB, último resultado)."""
+    tempos = []
+    resultado = None
+    for _ in range(repeticoes):
+        resultado = None
+        gc.collect()
+        inicio = time.perf_counter()
+        resultado = funcao()
+        tempos.append(time.perf_counter() - inicio)
+    resultado = None
+    gc.collect()
+    tracemalloc.start()
+    try:
+        resultado = funcao()
+        _, pico = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return min(tempos), float(np.median(tempos)), pico / 1024 / 1024, resultado
+
+
+def etapas(planilha, n_carta, semente):
+    """Etapas na ordem do app; cada uma recebe o dicionário de estado e devolve a função a medir."""
+    rng = np.random.default_rng(semente)
+    estado = {}
+
+    def ler():
+        return cv.ler_excel_vinhos(planilha)
+
+    def sidecar():
+        chave = cv.chave_catalogo(planilha)
+        cv._gravar_sidecar(planilha, chave, estado["df"])
+        return cv._ler_sidecar(planilha, chave)
+
+    def indice_busca():
+        return cv.construir_indice_busca(estado["df"])
+
+    def busca():
+        return [cv.mascara_busca(estado["df"], termo, estado["indice"]) for termo in BUSCAS]
+
+    def facetas():
+        indice = cv.construir_facetas(estado["df"])
+        cv.filtrar_facetas(indice, estado["df"], {})
+        return cv.filtrar_facetas(indice, estado["df"], {"pais": "Chile", "tipo": "Vinhos Tintos"})
+
+    def matriz_precos():
+        return cv.construir_matriz_precos(estado["df"])
+
+    def precos():
+        # Caminho de cada rerun do app: tabela escolhida sobre a matriz + ajustes manuais (1% dos itens)
+        df = cv.aplicar_tabela(estado["df"].copy(deep=False), estado["matriz"], "preco15", 2.0)
+        idxs = df["idx"].to_numpy()
+        alvo = idxs[rng.integers(0, len(idxs), max(len(idxs) // 100, 1))]
+        cv.precificar(df, 2.0, {int(i): 1.8 for i in alvo[::2]}, {int(i): 99.9 for i in alvo[1::2]},
+                      produtos=estado["produtos"])
+        return df
+
+    def ordenar():
+        return cv.ordenar_para_saida(estado["precos"])
+
+    def carta():
+        return cv.montar_carta(estado["selecao"], inserir_foto=True)
+
+    def pdf():
+        return cv.gerar_pdf(estado["carta"], "Sugestão Carta de Vinhos", "Benchmark", True)
+
+    def pdf_arquivo():
+        destino = os.path.join(os.path.dirname(planilha), "benchmark.pdf")
+        cv.gerar_pdf(estado["carta"], "Sugestão Carta de Vinhos", "Benchmark", True, destino=destino)
+        return os.path.getsize(destino)
+
+    def excel_openpyxl():
+        return cv.exportar_excel_like_pdf(estado["carta"], inserir_foto=True)
+
+    def excel_streaming():
+        return cv.exportar_excel_streaming(estado["carta"], inserir_foto=True)
+
+    def guardar(nome):
+        def depois(resultado):
+            estado[nome] = resultado
+            if nome == "matriz":
+                estado["produtos"] = cv.IndiceProdutos(estado["df"])  # Derivado por versão do catálogo, como no app
+            if nome == "precos":
+                df = resultado
+                n_sel = len(df) if n_carta <= 0 else min(n_carta, len(df))
+                pos = np.sort(rng.choice(len(df), size=n_sel, replace=False))
+                estado["selecao"] = df.iloc[pos]
+        return depois
+
+    nada = lambda resultado: None
+    lista = [("ler_excel_vinhos", ler, guardar("df")),
+             ("indice_busca", indice_busca, guardar("indice")),
+             ("busca", busca, nada),
+             ("facetas", facetas, nada),
+             ("matriz_precos", matriz_precos, guardar("matriz")),
+             ("precos", precos, guardar("precos")),
+             ("ordenar_para_saida", ordenar, nada),
+             ("montar_carta", carta, guardar("carta")),
+             ("gerar_pdf", pdf, nada),
+             ("gerar_pdf_arquivo", pdf_arquivo, nada),
+             ("exportar_excel_like_pdf", excel_openpyxl, nada)]
+    if cv.pq is not None:
+        lista.insert(1, ("sidecar_parquet", sidecar, nada))
+    if cv.xlsxwriter is not None:
+        lista.append(("exportar_excel_streaming", excel_streaming, nada))
+    return lista
+
+
+def rodar(args):
+    resultados = []
+    for n in args.tamanhos:
+        print(f"[{n} itens]")
+        planilha, imagens = preparar_catalogo(n, args.dados, args.semente, args.regerar)
+        # Fotos e miniaturas do benchmark ficam fora das pastas do app
+        cv.IMAGEM_DIRS[:] = [imagens]
+        cv.MINIATURA_DIR = os.path.join(imagens, ".cache")
+        for etapa, funcao, depois in etapas(planilha, args.carta, args.semente):
+            minimo, mediana, pico, resultado = medir(funcao, args.repeticoes)
+            depois(resultado)
+            resultados.append({"tamanho": n, "etapa": etapa, "segundos": round(minimo, 6),
+                               "mediana": round(mediana, 6), "pico_mb": round(pico, 2)})
+            print(f"  {etapa:<26} {minimo:9.4f}s  (mediana {mediana:.4f}s)  pico {pico:8.1f} MB")
+    return {
+        "versao": RESULTADO_VERSAO,
+        "data": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "ambiente": {"python": platform.python_version(), "plataforma": platform.platform(),
+                     "pandas": pd.__version__, "numpy": np.__version__,
+                     "pyarrow": cv.pa.__version__ if cv.pa is not None else None,
+                     "xlsxwriter": cv.xlsxwriter.__version__ if cv.xlsxwriter is not None else None},
+        "parametros": {"tamanhos": args.tamanhos, "repeticoes": args.repeticoes, "carta": args.carta,
+                       "semente": args.semente},
+        "resultados": resultados,
+    }
+
+
+def comparar(atual, base, tolerancia):
+    """Imprime a comparação com a base e devolve a lista de regressões (tamanho, etapa, razão)."""
+    anteriores = {(r["tamanho"], r["etapa"]): r for r in base.get("resultados", [])}
+    regressoes = []
+    print(f"\nComparação com a base de {base.get('data', '?')} (tolerância {tolerancia:.0%}):")
+    for r in atual["resultados"]:
+        ant = anteriores.get((r["tamanho"], r["etapa"]))
+        if ant is None:
+            continue
+        razao = r["segundos"] / ant["segundos"] if ant["segundos"] else float("inf")
+        marca = ""
+        if razao > 1 + tolerancia and r["segundos"] - ant["segundos"] > RUIDO_SEGUNDOS:
+            marca = "  REGRESSÃO"
+            regressoes.append((r["tamanho"], r["etapa"], razao))
+        elif razao < 1 - tolerancia and ant["segundos"] - r["segundos"] > RUIDO_SEGUNDOS:
+            marca = "  melhora"
+        print(f"  {r['tamanho']:>7} {r['etapa']:<26} {ant['segundos']:9.4f}s -> {r['segundos']:9.4f}s "
+              f"({razao:5.2f}x)  pico {ant['pico_mb']:.1f} -> {r['pico_mb']:.1f} MB{marca}")
+    return regressoes
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark das etapas da carta sobre catálogos sintéticos.")
+    ap.add_argument("--tamanhos", default="1000,10000,100000", help="Nº de itens dos catálogos, separados por vírgula")
+    ap.add_argument("--repeticoes", type=int, default=3, help="Execuções por etapa; vale o menor tempo (padrão: 3)")
+    ap.add_argument("--carta", type=int, default=1000, help="Itens da seleção usada no PDF/Excel; 0 = catálogo inteiro (padrão: 1000)")
+    ap.add_argument("--semente", type=int, default=42)
+    ap.add_argument("--dados", default=os.path.join(tempfile.gettempdir(), "carta_benchmark"),
+                    help="Pasta dos catálogos sintéticos (reaproveitados entre execuções)")
+    ap.add_argument("--regerar", action="store_true", help="Gera os catálogos de novo mesmo se já existirem")
+    ap.add_argument("--saida", default=os.path.join(BENCH_DIR, "ultimo.json"), help="Arquivo JSON do resultado")
+    ap.add_argument("--base", default=os.path.join(BENCH_DIR, "base.json"), help="Resultado base para comparação")
+    ap.add_argument("--gravar-base", action="store_true", help="Grava este resultado também como a nova base")
+    ap.add_argument("--tolerancia", type=float, default=0.20, help="Aumento de tempo aceito antes de acusar regressão (padrão: 0.20)")
+    args = ap.parse_args(argv)
+    args.tamanhos = [int(t) for t in args.tamanhos.split(",") if t.strip()]
+    args.repeticoes = max(1, args.repeticoes)
+    return args
+
+
+def _gravar_json(path, dados):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(dados, f, ensure_ascii=False, indent=2)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    atual = rodar(args)
+    _gravar_json(args.saida, atual)
+    print(f"\nResultado gravado em {args.saida}")
+    regressoes = []
+    if not args.gravar_base and os.path.exists(args.base):
+        with open(args.base, encoding="utf-8") as f:
+            regressoes = comparar(atual, json.load(f), args.tolerancia)
+    if args.gravar_base:
+        _gravar_json(args.base, atual)
+        print(f"Base gravada em {args.base}")
+    if regressoes:
+        print(f"\n{len(regressoes)} regressão(ões) acima de {args.tolerancia:.0%}.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
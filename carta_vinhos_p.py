@@ -19,14 +19,52 @@ Novidades:
 - Adicionada coluna 'preco_base' antes de 'preco_de_venda' na grade do st.data_editor.
 - Ocultada coluna 'idx' da grade do st.data_editor, mantendo-a internamente para lógica de seleção.
 - Corrigido KeyError em update_selections mantendo idx no DataFrame interno.
+- Catálogo carregado uma vez por versão do arquivo (caminho + mtime + tamanho), com cache colunar (.cache.parquet) ao lado da planilha.
+- Busca global por índice invertido de tokens (sem acentos, por prefixo, vários termos com E).
+- Fotos resolvidas por índice das pastas de imagens (CARTA_IMAGENS, separadas por os.pathsep; padrão ./imagens), atualizado pelo mtime da pasta.
+- Fotos do PDF/Excel embutidas a partir de miniaturas reduzidas em imagens/.cache (limitado por tamanho, remove as mais antigas).
+- Pré-visualização, PDF e Excel desenham o mesmo modelo da carta (montar_carta), agrupado uma vez e cacheado na sessão.
+- gerar_cartas_lote.py: regenera em lote (sem Streamlit, em paralelo) as cartas de todas as sugestões salvas.
+- Exportação Excel em streaming com xlsxwriter (memória limitada, formatos compartilhados, fotos repetidas embutidas uma vez), com openpyxl como alternativa.
+- Sugestões salvas em SQLite (sugestoes/sugestoes.db, modo WAL, mescla transacional); os antigos .txt são importados uma vez.
+- Ajustes manuais de fator/preço de venda aplicados de forma vetorizada (precificar), recalculando só as linhas alteradas.
+- Filtros da barra lateral por índice de facetas (opções pré-ordenadas por versão do catálogo, interseção de máscaras e contagem por opção).
+- Seleção guardada como bitmap NumPy alinhado ao idx do catálogo (marcar, desmarcar e filtrar sem conjuntos Python).
+- Grade paginada: tamanho de página, navegação e ordenação feitos no servidor; só a página atual vai para o navegador.
+- benchmark_carta.py: mede tempo e pico de memória de cada etapa em catálogos sintéticos (1k/10k/100k) e compara com um resultado base.
+- Painel "Desempenho" na barra lateral: tempo, linhas, bytes e (opcional) pico de memória por etapa de cada rerun, exportável em JSON lines (CARTA_DESEMPENHO_LOG grava de todas as sessões).
+- PDF/Excel gerados ficam num cache LRU (limitado em bytes; CARTA_ARTEFATOS_DIR transborda para disco): repetir a exportação ou baixar de novo não redesenha a carta.
+- Planilha atualizada com o app no ar: recarga incremental por cod + hash da linha (idx preservado, índices de busca/facetas reaproveitados quando só preços mudaram) e resumo de novos/removidos/alterados.
+- PDF/Excel gerados em segundo plano (fila de threads): barra de progresso com itens/páginas, cancelamento, e a grade continua utilizável enquanto o arquivo é montado.
+- Preços base de todas as tabelas numa matriz por versão do catálogo: trocar a tabela não reprocessa a planilha; "Visualizar Itens Marcados" mostra o preço de venda em todas as tabelas lado a lado.
+- Catálogo único e compacto por processo (pais/região/tipo/uvas/vinícola como category); cada sessão trabalha sobre visões por posição e guarda só seleção e ajustes.
+- Tipo normalizado calculado uma vez na carga (tipo_norm, category na ordem fixa das seções): ordenação, agrupamento e contagens de Espumantes/Frisantes/… por value_counts, sem reclassificar texto por linha.
+- Produtos cadastrados vão para um diário append-only ao lado da planilha (<planilha>.cadastros.jsonl), compartilhado entre sessões e aplicado pelo catálogo uma vez por versão do diário; "Compactar cadastros" reescreve o diário e grava tudo no sidecar Parquet.
+- PDF: cabeçalho (logos, título, cliente) e partes fixas do rodapé viram formulários (Form XObject) desenhados uma vez por documento; cada página só os referencia e desenha as contagens.
+- Cartas grandes (CARTA_EXPORTACAO_ARQUIVO_MIN_ITENS, padrão 1000 itens) são renderizadas direto em arquivo: o PDF sai em partes de 25 páginas unidas no fim, com pico de memória estável, e o download lê o arquivo só no clique.
+- Aba "Análise das Sugestões": todas as sugestões salvas numa matriz esparsa sugestão x produto (CSR), com vinhos mais sugeridos, sobreposição entre clientes e sugestões afetadas pela última atualização da planilha.
+- idx estável por cod também entre reinícios (mapa cod -> idx lido do sidecar anterior; idx de produto removido não é reaproveitado) e IndiceProdutos idx -> linha por versão do catálogo: seleções, ajustes e sugestões resolvidos em O(k), sem varrer o catálogo.
 """
 
 import os
 import io
+import re
+import json
+import bisect
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import tracemalloc
+import unicodedata
+from contextlib import closing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import time
 
 import streamlit as st
+import numpy as np
 import pandas as pd
 from PIL import Image
 
@@ -49,23 +87,66 @@ except ImportError:
     st.error("Módulo 'openpyxl' não encontrado. Instale com: pip install openpyxl")
     raise
 
+# --- Excel em streaming (xlsxwriter) opcional; sem ele a exportação usa openpyxl ---
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+# --- Parquet (pyarrow) opcional, usado no cache colunar do catálogo ---
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
 # --- Constantes e diretórios ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 IMAGEM_DIR = os.path.join(BASE_DIR, "imagens")
 SUGESTOES_DIR = os.path.join(BASE_DIR, "sugestoes")
 CARTA_DIR = os.path.join(BASE_DIR, "CARTA")
 LOGO_PADRAO = os.path.join(CARTA_DIR, "logo_inga.png")
+# Pastas de fotos em ordem de prioridade (variável de ambiente CARTA_IMAGENS, separadas por os.pathsep)
+IMAGEM_DIRS = [p for p in os.environ.get("CARTA_IMAGENS", "").split(os.pathsep) if p] or [IMAGEM_DIR]
+IMAGEM_EXTS = [".png", ".jpg", ".jpeg"]  # Ordem de preferência quando há mais de um arquivo para o mesmo código
+IMAGEM_INDICE_TTL = 2.0  # Segundos entre verificações do mtime das pastas
+MINIATURA_DIR = os.path.join(IMAGEM_DIR, ".cache")
+MINIATURA_ESCALA = 3  # Pixels por ponto exibido, para a foto continuar nítida na impressão
+MINIATURA_CACHE_MAX_BYTES = 64 * 1024 * 1024
 
 TIPO_ORDEM_FIXA = [
     "Espumantes", "Frisantes", "Vinhos Brancos", "Vinhos Rosés",
     "Vinhos Tintos", "Fortificados", "Vinhos Sobremesas", "Licorosos"
 ]
 
+TABELAS_PRECO = ["preco1", "preco2", "preco15", "preco38", "preco39", "preco55", "preco63"]
+COLUNAS_PRECO = ["preco38","preco39","preco1","preco2","preco15","preco55","preco63","preco_base","fator","preco_de_venda"]
+# Texto de baixa cardinalidade guardado como category no catálogo compartilhado (códigos + uma cópia de cada valor)
+COLUNAS_CATEGORIA = ["pais","regiao","tipo","uva1","uva2","uva3","vinicola","corpo"]
+COLUNAS_TEXTO = ["cod","descricao","pais","regiao","tipo","uva1","uva2","uva3","amadurecimento","vinicola","corpo","visual","olfato","gustativo","premiacoes"]
+COLUNAS_NAO_TEXTO = set(COLUNAS_PRECO) | {"idx", "tipo_norm"}  # tipo_norm é derivado de tipo
+
+def colunas_texto(df):
+    """
+    Colunas de texto da planilha carregada: todas menos preços, idx e derivadas (uva4..uva8, nomeecommerce,
+    harmonizacao etc. entram). COLUNAS_TEXTO são só as que o app garante existir.
+    """
+    return [c for c in df.columns if c not in COLUNAS_NAO_TEXTO]
+
+CATALOGO_SIDECAR_SUFIXO = ".cache.parquet"
+CATALOGO_SIDECAR_VERSAO = 3  # Incrementar ao mudar a normalização feita em ler_excel_vinhos
+
 # ===== Helpers =====
 def garantir_pastas():
     for p in (IMAGEM_DIR, SUGESTOES_DIR, CARTA_DIR):
         os.makedirs(p, exist_ok=True)
 
+def ler_indices_sugestao(path):
+    """Índices (idx) gravados em sugestoes/<nome>.txt, separados por vírgula."""
+    with open(path) as f:
+        return [int(x) for x in f.read().strip().split(",") if x]
+
 def parse_money_series(s, default=0.0):
     """Converte série textual com possível separador de milhar '.' e decimal ',' em float."""
     s = s.astype(str).str.replace("\u00A0", "", regex=False).str.strip()
@@ -80,6 +161,10 @@ def to_float_series(s, default=0.0):
     except Exception:
         return pd.to_numeric(s, errors="coerce").fillna(default)
 
+def _texto_limpo(serie):
+    s = serie.astype(object).where(serie.notna(), "").astype(str).str.strip()
+    return s.mask(s.str.lower().isin(("nan", "none")), "")
+
 def ler_excel_vinhos(caminho="vinhos1.xls"):
     if not os.path.exists(caminho):
         st.error(f"Arquivo {caminho} não encontrado. Verifique o caminho ou forneça um arquivo XLS/XLSX válido.")
@@ -104,41 +189,1091 @@ def ler_excel_vinhos(caminho="vinhos1.xls"):
     if "idx" not in df.columns or df["idx"].isna().all():
         df = df.reset_index(drop=False).rename(columns={"index": "idx"})
     df["idx"] = pd.to_numeric(df["idx"], errors="coerce").fillna(-1).astype(int)
-    for col in ["preco38","preco39","preco1","preco2","preco15","preco55","preco63","preco_base","fator","preco_de_venda"]:
+    for col in COLUNAS_PRECO:
         if col not in df.columns:
             df[col] = 0.0
         else:
             df[col] = to_float_series(df[col], default=0.0)
-    for col in ["cod","descricao","pais","regiao","tipo","uva1","uva2","uva3","amadurecimento","vinicola","corpo","visual","olfato","gustativo","premiacoes"]:
+    for col in COLUNAS_TEXTO:
         if col not in df.columns:
             df[col] = ""
         df[col] = df[col].astype(str)
+    for col in COLUNAS_CATEGORIA:
+        if df[col].nunique() <= max(1, len(df) // 2):
+            df[col] = df[col].astype("category")
+    df["tipo_norm"] = tipo_normalizado(df["tipo"])
     return df
 
-def get_imagem_file(cod: str):
-    caminho_win = os.path.join(r"C:/carta/imagens", f"{cod}.png")
-    if os.path.exists(caminho_win):
-        return caminho_win
-    for ext in ['.png', '.jpg', '.jpeg', '.PNG', '.JPG', '.JPEG']:
-        img_path = os.path.join(IMAGEM_DIR, f"{cod}{ext}")
-        if os.path.exists(img_path):
-            return os.path.abspath(img_path)
+# ===== Cache do catálogo =====
+@st.cache_resource
+def _registro_processo():
+    """Estado compartilhado por todas as sessões do processo (sobrevive aos reruns do script)."""
+    return {"lock": threading.RLock()}
+
+def chave_catalogo(caminho):
+    """Versão do arquivo de dados: (caminho absoluto, mtime_ns, tamanho) ou None se não existir."""
     try:
-        for fname in os.listdir(IMAGEM_DIR):
-            if fname.startswith(str(cod)):
-                return os.path.abspath(os.path.join(IMAGEM_DIR, fname))
+        info = os.stat(caminho)
+    except OSError:
+        return None
+    return (os.path.abspath(caminho), info.st_mtime_ns, info.st_size)
+
+SIDECAR_ATTRS = ("proximo_idx",)  # Únicos attrs gravados no sidecar (delta, chave_catalogo etc. valem só para a carga atual)
+
+def _origem_sidecar(chave):
+    return {"mtime_ns": chave[1], "size": chave[2], "versao": CATALOGO_SIDECAR_VERSAO}
+
+def _ler_sidecar(caminho, chave):
+    path = caminho + CATALOGO_SIDECAR_SUFIXO
+    if pq is None or not os.path.exists(path):
+        return None
+    try:
+        meta = pq.read_schema(path).metadata or {}
+        if json.loads(meta.get(b"carta_origem", b"{}")) != _origem_sidecar(chave):
+            return None
+        df = pq.read_table(path).to_pandas()
+        df.attrs = {k: v for k, v in df.attrs.items() if k in SIDECAR_ATTRS}  # Sidecars antigos gravavam todos os attrs
+        # Sidecar compactado (compactar_cadastros): linhas do diário depois das n_base da planilha
+        cad = json.loads(meta.get(b"carta_cadastros", b"{}"))
+        df.attrs["n_base"] = int(cad.get("n_base", len(df)))
+        if cad.get("diario"):
+            df.attrs["versao_cadastros"] = tuple(cad["diario"])
+        return df
     except Exception:
+        return None
+
+def _gravar_sidecar(caminho, chave, df, cadastros=None):
+    if pa is None:
+        return
+    path = caminho + CATALOGO_SIDECAR_SUFIXO
+    tmp = f"{path}.{os.getpid()}.tmp"
+    try:
+        gravar = df.copy(deep=False)
+        gravar.attrs = {k: v for k, v in df.attrs.items() if k in SIDECAR_ATTRS}
+        tabela = pa.Table.from_pandas(gravar, preserve_index=False)
+        meta = dict(tabela.schema.metadata or {})
+        meta[b"carta_origem"] = json.dumps(_origem_sidecar(chave)).encode()
+        if cadastros:
+            meta[b"carta_cadastros"] = json.dumps(cadastros).encode()
+        # Maior idx já usado + 1: produto removido da planilha não tem o idx reaproveitado por outro
+        proximo = max(int(df["idx"].max()) + 1 if len(df) else 0, int(df.attrs.get("proximo_idx", 0)))
+        meta[b"carta_idx"] = json.dumps({"proximo": proximo}).encode()
+        pq.write_table(tabela.replace_schema_metadata(meta), tmp)
+        os.replace(tmp, path)
+    except Exception:
+        # Sem cache em disco o catálogo continua válido; apenas o próximo processo relê a planilha.
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+
+def catalogo_base(df):
+    """Só as linhas da planilha (sem os cadastros do diário): visão posicional, sem cópia."""
+    n = df.attrs.get("n_base", len(df))
+    return df if n >= len(df) else df.iloc[:n]
+
+def carregar_catalogo(caminho="vinhos1.xls"):
+    """
+    Catálogo normalizado, compartilhado entre reruns e sessões (somente leitura: use .copy(deep=False) e
+    substitua colunas inteiras; com copy-on-write as demais continuam compartilhadas).
+    A planilha só é relida quando muda; entre reinícios do processo usa-se o sidecar Parquet.
+    Os produtos do diário de cadastros vêm depois das attrs["n_base"] linhas da planilha.
+    """
+    chave = chave_catalogo(caminho)
+    if chave is None:
+        return ler_excel_vinhos(caminho)
+    reg = _registro_processo()
+    with reg["lock"]:
+        catalogos = reg.setdefault("catalogos", {})
+        atual = catalogos.get(chave[0])
+        diario = versao_cadastros(caminho)
+        if atual is not None and atual[0] == chave:
+            if atual[1].attrs.get("versao_cadastros") == diario:
+                return atual[1]
+            df = catalogo_base(atual[1])  # Só o diário mudou: a planilha não é relida
+        else:
+            df = _ler_sidecar(caminho, chave)
+            novo_arquivo = df is None
+            if df is None:
+                df = ler_excel_vinhos(caminho)
+                if df is None:
+                    return None
+                if atual is None and "cod" in df.columns and np.array_equal(df["idx"].to_numpy(), np.arange(len(df))):
+                    # idx gerado pela posição: volta ao idx que cada cod tinha no sidecar anterior (sugestões,
+                    # seleções e ajustes continuam no mesmo vinho mesmo com linhas reordenadas na planilha)
+                    anterior = _idx_persistidos(caminho)
+                    if anterior is not None:
+                        reatribuir_idx(df, *anterior, proximo_idx=_proximo_idx_cadastros(caminho))
+            elif df.attrs.get("versao_cadastros") == diario and atual is None:
+                df.attrs["chave_catalogo"] = chave
+                catalogos[chave[0]] = (chave, df)
+                return df
+            df = catalogo_base(df)
+            resumo = None
+            if atual is not None:
+                # Planilha atualizada com o processo no ar: idx preservado por cod, índices derivados reaproveitados
+                df, resumo = aplicar_delta(catalogo_base(atual[1]), df, _proximo_idx_cadastros(caminho))
+                if resumo is not None:
+                    _migrar_derivados(chave, atual[0], df, resumo)
+            if novo_arquivo:
+                _gravar_sidecar(caminho, chave, df)
+            df.attrs["chave_catalogo"] = chave
+            if resumo is not None:
+                df.attrs["delta"] = {k: v for k, v in resumo.items() if k not in ("posicoes", "idx_alterados")}
+                # Fora de attrs (o Streamlit serializa attrs junto com cada tabela exibida)
+                derivado_do_catalogo("alterados", chave, lambda: resumo["idx_alterados"])
+        df = aplicar_cadastros(df, ler_cadastros(caminho))
+        df.attrs["versao_cadastros"] = diario
+        catalogos[chave[0]] = (chave, df)
+        return df
+
+# ===== Diário de cadastros (append-only, ao lado da planilha) =====
+CADASTROS_SUFIXO = ".cadastros.jsonl"
+
+def versao_cadastros(caminho):
+    """(mtime_ns, tamanho) do diário de cadastros, ou None se ainda não existir."""
+    try:
+        info = os.stat(caminho + CADASTROS_SUFIXO)
+    except OSError:
+        return None
+    return (info.st_mtime_ns, info.st_size)
+
+def ler_cadastros(caminho):
+    """Registros do diário, um por cod (o último vale); cadastros sem cod continuam todos."""
+    registros = []
+    try:
+        with open(caminho + CADASTROS_SUFIXO, encoding="utf-8") as f:
+            for linha in f:
+                try:
+                    registros.append(json.loads(linha))
+                except ValueError:
+                    pass  # Linha incompleta (gravação interrompida)
+    except OSError:
+        return []
+    vistos, saida = set(), []
+    for r in reversed(registros):
+        cod = str(r.get("cod") or "")
+        if cod and cod in vistos:
+            continue
+        vistos.add(cod)
+        saida.append(r)
+    return saida[::-1]
+
+def _proximo_idx_cadastros(caminho):
+    return max((int(r["idx"]) for r in ler_cadastros(caminho) if "idx" in r), default=-1) + 1
+
+def aplicar_cadastros(base, registros):
+    """
+    base + produtos do diário numa única cópia, feita uma vez por versão do diário (não a cada rerun).
+    As colunas category continuam category (valores novos viram categorias novas); idx que colidam com a
+    planilha recebem idx novos.
+    """
+    base.attrs["n_base"] = len(base)
+    if not registros:
+        return base
+    extra = pd.DataFrame(registros).reindex(columns=base.columns)
+    for col in colunas_texto(extra):
+        if not pd.api.types.is_numeric_dtype(base[col]):  # Coluna numérica da planilha (ex.: safra) fica como está
+            extra[col] = extra[col].map(lambda v: "" if v is None or v != v else str(v))
+    extra["idx"] = pd.to_numeric(extra["idx"], errors="coerce").fillna(-1).astype(int)
+    colide = extra["idx"].isin(base["idx"]) | extra["idx"].duplicated() | (extra["idx"] < 0)
+    if colide.any():
+        proximo = int(max(base["idx"].max(), extra["idx"].max(), -1)) + 1
+        extra.loc[colide, "idx"] = np.arange(proximo, proximo + int(colide.sum()))
+    extra["tipo_norm"] = tipo_normalizado(extra["tipo"]).astype(object)
+    base = base.copy(deep=False)
+    for col in base.columns:
+        if not isinstance(base[col].dtype, pd.CategoricalDtype):
+            continue
+        novas = [v for v in pd.unique(extra[col]) if v not in base[col].cat.categories]
+        if novas:
+            base[col] = base[col].cat.add_categories(novas)
+            if col == "tipo_norm":
+                categorias = list(base[col].cat.categories)
+                base[col] = base[col].cat.reorder_categories(TIPO_ORDEM_FIXA + sorted(categorias[len(TIPO_ORDEM_FIXA):]))
+        extra[col] = pd.Categorical(extra[col], dtype=base[col].dtype)
+    df = pd.concat([base, extra], ignore_index=True)
+    df.attrs = dict(base.attrs)
+    return df
+
+def registrar_cadastro(caminho, item):
+    """
+    Acrescenta um produto ao diário (uma linha JSON), visível para todas as sessões no próximo rerun.
+    Cod já cadastrado mantém o idx anterior (o novo registro substitui o antigo); senão recebe um idx novo.
+    """
+    reg = _registro_processo()
+    with reg["lock"]:
+        registros = ler_cadastros(caminho)
+        cod = str(item.get("cod") or "")
+        anterior = next((r for r in registros if cod and str(r.get("cod") or "") == cod), None)
+        if anterior is not None:
+            idx = int(anterior["idx"])
+        else:
+            catalogo = carregar_catalogo(caminho)
+            maior = int(catalogo["idx"].max()) if catalogo is not None and len(catalogo) else -1
+            idx = max(maior + 1, _proximo_idx_cadastros(caminho))
+        item = dict(item, idx=idx)
+        with open(caminho + CADASTROS_SUFIXO, "a", encoding="utf-8") as f:
+            f.write(json.dumps(item, ensure_ascii=False, default=str) + "\n")
+        return item
+
+def compactar_cadastros(caminho):
+    """
+    Reescreve o diário só com os registros vigentes e grava planilha + cadastros no sidecar, de modo que o
+    próximo processo carrega tudo numa leitura de Parquet. Devolve o número de registros vigentes.
+    """
+    reg = _registro_processo()
+    with reg["lock"]:
+        registros = ler_cadastros(caminho)
+        path = caminho + CADASTROS_SUFIXO
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.writelines(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in registros)
+        os.replace(tmp, path)
+        df = carregar_catalogo(caminho)
+        chave = chave_catalogo(caminho)
+        if df is not None and chave is not None:
+            _gravar_sidecar(caminho, chave, df, {"n_base": df.attrs.get("n_base", len(df)),
+                                                 "diario": list(df.attrs.get("versao_cadastros") or ())})
+        return len(registros)
+
+# ===== Recarga incremental (delta por cod) =====
+DERIVADOS_SO_TEXTO = {"busca", "facetas"}  # Derivados que só leem colunas_texto (continuam válidos se só preços mudaram)
+DELTA_MAX_EXTRA = 0.05  # Fração de linhas além das indexadas antes de reconstruir os derivados
+
+def _chaves_produto(df):
+    """Chave estável de cada linha: cod normalizado + ocorrência (cods repetidos ou vazios continuam distintos)."""
+    cod = _texto_limpo(df["cod"])
+    cod = cod.map({v: _cod_texto(v) for v in pd.unique(cod)})
+    return (cod + "#" + cod.groupby(cod).cumcount().astype(str)).to_numpy()
+
+def _hash_linhas(df, colunas):
+    return pd.util.hash_pandas_object(df[colunas].astype(str), index=False).to_numpy()
+
+def aplicar_delta(antigo, novo, proximo_idx=0):
+    """
+    Compara a nova leitura da planilha com o catálogo em memória, por cod e hash do conteúdo de cada linha.
+    Devolve (catálogo, resumo): linhas existentes ficam na mesma posição e com o mesmo idx (seleções, ajustes
+    e sugestões continuam apontando para o mesmo vinho), as novas entram no fim com idx novos (a partir de
+    proximo_idx, para não reutilizar os do diário de cadastros) e as removidas saem.
+    Sem cod ou com colunas diferentes devolve (novo, None): recarga completa.
+    """
+    colunas = [c for c in novo.columns if c != "idx"]
+    if "cod" not in novo.columns or sorted(colunas) != sorted(c for c in antigo.columns if c != "idx"):
+        return novo, None
+    ka, kn = _chaves_produto(antigo), _chaves_produto(novo)
+    pos_novo = pd.Index(kn).get_indexer(ka)
+    mantidos = np.flatnonzero(pos_novo >= 0)
+    origem = pos_novo[mantidos]
+    presentes = np.zeros(len(novo), dtype=bool)
+    presentes[origem] = True
+    adicionados = np.flatnonzero(~presentes)
+
+    alterados = _hash_linhas(antigo.iloc[mantidos], colunas) != _hash_linhas(novo.iloc[origem], colunas)
+    textos = [c for c in colunas_texto(novo) if c in colunas]
+    texto_alterado = alterados.copy()
+    if alterados.any():
+        sub = np.flatnonzero(alterados)
+        texto_alterado[sub] = (_hash_linhas(antigo.iloc[mantidos[sub]], textos) !=
+                               _hash_linhas(novo.iloc[origem[sub]], textos))
+
+    df = novo.iloc[np.concatenate([origem, adicionados])].reset_index(drop=True)
+    idx_antigo = antigo["idx"].to_numpy()[mantidos]
+    proximo = max(int(max(antigo["idx"].max(), -1)) + 1, int(proximo_idx), int(antigo.attrs.get("proximo_idx", 0)))
+    df["idx"] = np.concatenate([idx_antigo, np.arange(proximo, proximo + len(adicionados))]).astype(int)
+    df = df[list(novo.columns)]
+    df.attrs["proximo_idx"] = proximo + len(adicionados)
+
+    cods = lambda k: [c.rsplit("#", 1)[0] for c in k[:10]]
+    resumo = {
+        "adicionados": int(len(adicionados)), "removidos": int(len(antigo) - len(mantidos)),
+        "alterados": int(alterados.sum()), "so_preco": int((alterados & ~texto_alterado).sum()),
+        "exemplos": {"adicionados": cods(kn[adicionados]), "removidos": cods(ka[pos_novo < 0]),
+                     "alterados": cods(ka[mantidos[alterados]])},
+        "idx_alterados": idx_antigo[alterados],
+        # Derivados posicionais continuam válidos se nenhuma linha saiu e nenhum texto indexado mudou
+        "posicoes": not (len(antigo) - len(mantidos)) and not texto_alterado.any(),
+    }
+    return df, resumo
+
+def _idx_persistidos(caminho):
+    """
+    (chaves, idx, próximo idx) das linhas da planilha no sidecar, mesmo desatualizado: é o mapa cod -> idx
+    persistido entre reinícios. Só lê as colunas cod e idx; None sem sidecar ou sem pyarrow.
+    """
+    path = caminho + CATALOGO_SIDECAR_SUFIXO
+    if pq is None or not os.path.exists(path):
+        return None
+    try:
+        meta = pq.read_schema(path).metadata or {}
+        anterior = pq.read_table(path, columns=["cod", "idx"]).to_pandas()
+        n_base = json.loads(meta.get(b"carta_cadastros", b"{}")).get("n_base", len(anterior))
+        proximo = json.loads(meta.get(b"carta_idx", b"{}")).get("proximo", 0)
+    except Exception:
+        return None
+    anterior = anterior.iloc[:int(n_base)]
+    return _chaves_produto(anterior), anterior["idx"].to_numpy(dtype=np.int64), int(proximo)
+
+def reatribuir_idx(df, chaves, idx, proximo=0, proximo_idx=0):
+    """
+    Dá a cada linha de df o idx que a mesma chave de produto (cod + ocorrência) tinha antes; linhas novas
+    recebem idx acima de todos os já usados. A ordem das linhas é a da planilha. Altera df.
+    """
+    pos = pd.Index(chaves).get_indexer(_chaves_produto(df))
+    novos = pos < 0
+    proximo = max(int(idx.max()) + 1 if len(idx) else 0, int(proximo), int(proximo_idx))
+    resultado = np.where(novos, -1, idx[np.maximum(pos, 0)] if len(idx) else -1)
+    resultado[novos] = np.arange(proximo, proximo + int(novos.sum()))
+    df["idx"] = resultado.astype(int)
+    df.attrs["proximo_idx"] = proximo + int(novos.sum())
+    return df
+
+def _migrar_derivados(chave, chave_antiga, df, resumo):
+    """Passa para a nova versão os derivados de texto ainda válidos; os demais serão reconstruídos sob demanda."""
+    if not resumo["posicoes"]:
+        return
+    derivados = _registro_processo().setdefault("derivados", {})
+    for (nome, caminho), (versao, valor) in list(derivados.items()):
+        if caminho != chave[0] or versao != chave_antiga or nome not in DERIVADOS_SO_TEXTO:
+            continue
+        n = valor.get("n", 0) if isinstance(valor, dict) else 0
+        if len(df) - n <= max(100, DELTA_MAX_EXTRA * n):  # Linhas novas além de n: tratadas como extras pela busca/facetas
+            derivados[(nome, caminho)] = (chave, valor)
+
+def derivado_do_catalogo(nome, chave, construir):
+    """Estrutura derivada do catálogo (índices, tabelas auxiliares), construída uma vez por versão do arquivo."""
+    if chave is None:
+        return construir()
+    reg = _registro_processo()
+    with reg["lock"]:
+        derivados = reg.setdefault("derivados", {})
+        atual = derivados.get((nome, chave[0]))
+        if atual is not None and atual[0] == chave:
+            return atual[1]
+        valor = construir()
+        derivados[(nome, chave[0])] = (chave, valor)
+        return valor
+
+# ===== Índice de busca =====
+_RE_TOKEN = re.compile(r"[0-9a-z]+")
+
+def normaliza_texto_busca(texto):
+    """Minúsculas e sem acentos ("Rosé Côtes" -> "rose cotes")."""
+    texto = unicodedata.normalize("NFKD", str(texto).lower())
+    return "".join(ch for ch in texto if not unicodedata.combining(ch))
+
+def construir_indice_busca(df):
+    """
+    Índice invertido token -> posições de linha sobre todas as colunas de texto da planilha (colunas_texto).
+    Os tokens ficam ordenados e as listas de linhas contíguas (CSR), então um prefixo é uma única fatia.
+    """
+    textos = pd.Series([""] * len(df), index=df.index, dtype=object)
+    for col in colunas_texto(df):
+        valores = df[col].astype(object)
+        valores = valores.where(valores.notna(), "").astype(str).replace({"nan": "", "None": ""})
+        normalizados = {v: normaliza_texto_busca(v) for v in pd.unique(valores)}
+        textos = textos + " " + valores.map(normalizados)
+    tokens_por_linha = textos.str.findall(_RE_TOKEN)
+    tamanhos = tokens_por_linha.str.len().fillna(0).to_numpy(dtype=np.int64)
+    todos = [t for lista in tokens_por_linha for t in lista]
+    # Trabalha com códigos inteiros (token ordenado * n + linha) em vez de ordenar strings
+    codigos, vocab = pd.factorize(pd.Series(todos, dtype=object))
+    vocab = np.asarray(vocab, dtype=object)
+    ordem = np.argsort(vocab.astype(str), kind="stable")
+    posto = np.empty(len(vocab), dtype=np.int64)
+    posto[ordem] = np.arange(len(vocab))
+    n = max(len(df), 1)
+    pares = np.unique(posto[codigos] * n + np.repeat(np.arange(len(df), dtype=np.int64), tamanhos))
+    token_id, linhas = np.divmod(pares, n)
+    tokens = vocab[ordem].tolist()
+    offsets = np.searchsorted(token_id, np.arange(len(tokens) + 1), side="left").astype(np.int64)
+    return {"tokens": tokens, "offsets": offsets, "linhas": linhas, "n": len(df)}
+
+def buscar_linhas(indice, termo):
+    """Posições das linhas que têm, para cada termo, algum token começando por ele. None = sem termo válido."""
+    termos = _RE_TOKEN.findall(normaliza_texto_busca(termo))
+    if not termos:
+        return None
+    resultado = None
+    tokens = indice["tokens"]
+    for t in sorted(set(termos), key=len, reverse=True):
+        ini = bisect.bisect_left(tokens, t)
+        fim = bisect.bisect_left(tokens, t + "\uffff", lo=ini)
+        linhas = np.unique(indice["linhas"][indice["offsets"][ini]:indice["offsets"][fim]])
+        resultado = linhas if resultado is None else np.intersect1d(resultado, linhas, assume_unique=True)
+        if not len(resultado):
+            break
+    return resultado
+
+def mascara_busca(df, termo, indice):
+    """Máscara booleana da busca global; linhas além das indexadas (diário de cadastros) usam um índice avulso."""
+    n_idx = min(indice["n"], len(df))
+    mask = np.zeros(len(df), dtype=bool)
+    linhas = buscar_linhas(indice, termo)
+    if linhas is None:
+        mask[:] = True
+        return mask
+    mask[linhas[linhas < n_idx]] = True
+    if len(df) > n_idx:
+        extra = buscar_linhas(construir_indice_busca(df.iloc[n_idx:]), termo)
+        mask[n_idx + extra] = True
+    return mask
+
+# ===== Índice de facetas (filtros da barra lateral) =====
+FACETAS_SIDEBAR = [("pais", "País", "filt_pais"), ("tipo", "Tipo", "filt_tipo"), ("descricao", "Descrição", "filt_desc"),
+                   ("regiao", "Região", "filt_regiao"), ("cod", "Código", "filt_cod")]
+
+def construir_facetas(df):
+    """
+    Por coluna de filtro: opções ordenadas, código de cada linha (-1 = vazio) e as linhas de cada opção
+    (CSR: linhas[offsets[c]:offsets[c+1]]). Construído uma vez por versão do catálogo.
+    """
+    facetas = {}
+    for col, _, _ in FACETAS_SIDEBAR:
+        valores = _texto_limpo(df[col]) if col in df.columns else pd.Series([""] * len(df), dtype=object)
+        opcoes = sorted(v for v in pd.unique(valores) if v)
+        mapa = {v: i for i, v in enumerate(opcoes)}
+        codigos = valores.map(mapa).fillna(-1).to_numpy(dtype=np.int64)
+        linhas = np.argsort(codigos, kind="stable")
+        offsets = np.searchsorted(codigos[linhas], np.arange(len(opcoes) + 1))
+        facetas[col] = {"opcoes": opcoes, "mapa": mapa, "codigos": codigos, "linhas": linhas, "offsets": offsets}
+    return {"facetas": facetas, "n": len(df)}
+
+def _faceta_estendida(faceta, col, df, n_idx):
+    """Códigos/opções da faceta incluindo linhas além das indexadas (diário de cadastros)."""
+    if len(df) <= n_idx:
+        return faceta["codigos"][:len(df)], faceta["mapa"], faceta["opcoes"]
+    extra = _texto_limpo(df[col].iloc[n_idx:]) if col in df.columns else pd.Series([""] * (len(df) - n_idx), dtype=object)
+    mapa = faceta["mapa"]
+    novas = sorted(v for v in set(extra) if v and v not in mapa)
+    if novas:
+        mapa = dict(mapa)
+        mapa.update({v: len(mapa) + i for i, v in enumerate(novas)})
+    cod_extra = extra.map(mapa).fillna(-1).to_numpy(dtype=np.int64)
+    opcoes = sorted(faceta["opcoes"] + novas) if novas else faceta["opcoes"]
+    return np.concatenate([faceta["codigos"], cod_extra]), mapa, opcoes
+
+def filtrar_facetas(indice, df, selecoes, mascara_base=None):
+    """
+    Aplica as seleções {coluna: valor} por interseção de máscaras e conta, para cada faceta, quantas linhas
+    cada opção teria com os demais filtros aplicados (busca facetada).
+    Devolve (máscara final, {coluna: contagens por código}, {coluna: (mapa, opções)}).
+    """
+    n = len(df)
+    n_idx = min(indice["n"], n)
+    base = np.ones(n, dtype=bool) if mascara_base is None else mascara_base
+    dados, mascaras = {}, {}
+    for col, _, _ in FACETAS_SIDEBAR:
+        faceta = indice["facetas"][col]
+        codigos, mapa, opcoes = _faceta_estendida(faceta, col, df, n_idx)
+        dados[col] = (codigos, mapa, opcoes)
+        valor = selecoes.get(col)
+        if not valor:
+            continue
+        m = np.zeros(n, dtype=bool)
+        c = mapa.get(valor)
+        if c is not None:
+            if c < len(faceta["opcoes"]):
+                linhas = faceta["linhas"][faceta["offsets"][c]:faceta["offsets"][c+1]]
+                m[linhas[linhas < n_idx]] = True
+            if n > n_idx:
+                m[n_idx:] = codigos[n_idx:] == c
+        mascaras[col] = m
+    final = base.copy()
+    for m in mascaras.values():
+        final &= m
+    contagens = {}
+    for col, (codigos, mapa, _) in dados.items():
+        outras = base.copy()
+        for c2, m in mascaras.items():
+            if c2 != col:
+                outras &= m
+        sel = codigos[outras]
+        contagens[col] = np.bincount(sel[sel >= 0], minlength=len(mapa))
+    return final, contagens, {col: (d[1], d[2]) for col, d in dados.items()}
+
+# ===== Seleção de itens =====
+SELECAO_BITMAP_MAX_IDX = 1 << 22  # idx acima disso (coluna idx própria na planilha) vão para um conjunto, não para o bitmap
+
+class SelecaoBitmap:
+    """
+    Itens selecionados como bitmap NumPy indexado pelo idx do catálogo (estável por cod; a linha vem de IndiceProdutos).
+    Pertinência e contagem são vetorizadas; edições da grade aplicam só as posições que mudaram.
+    idx >= SELECAO_BITMAP_MAX_IDX ficam num set à parte: um idx alto não faz cada sessão alocar um bitmap enorme.
+    """
+    __slots__ = ("bits", "_n", "_esparsos")
+
+    def __init__(self, idxs=()):
+        self.bits = np.zeros(0, dtype=bool)
+        self._n = 0
+        self._esparsos = set()
+        self.marcar(idxs)
+
+    def _garantir(self, maior):
+        if maior >= len(self.bits):
+            novo = np.zeros(min(max(maior + 1, 2 * len(self.bits), 1024), SELECAO_BITMAP_MAX_IDX), dtype=bool)
+            novo[:len(self.bits)] = self.bits
+            self.bits = novo
+
+    @staticmethod
+    def _como_array(idxs):
+        if not isinstance(idxs, (np.ndarray, pd.Series, list, tuple)):
+            idxs = list(idxs)
+        arr = pd.to_numeric(pd.Series(np.asarray(idxs).ravel()), errors="coerce").fillna(-1).to_numpy(dtype=np.int64)
+        return arr[arr >= 0]
+
+    def __len__(self):
+        return self._n
+
+    def __bool__(self):
+        return self._n > 0
+
+    def __iter__(self):
+        return iter(self.indices().tolist())
+
+    def __contains__(self, idx):
+        idx = int(idx)
+        if idx >= SELECAO_BITMAP_MAX_IDX:
+            return idx in self._esparsos
+        return 0 <= idx < len(self.bits) and bool(self.bits[idx])
+
+    def indices(self):
+        densos = np.flatnonzero(self.bits)
+        if not self._esparsos:
+            return densos
+        return np.concatenate([densos, np.array(sorted(self._esparsos), dtype=np.int64)])
+
+    def mascara(self, idxs):
+        """Array booleano: quais dos idx informados estão selecionados."""
+        idxs = np.asarray(idxs, dtype=np.int64)
+        ok = (idxs >= 0) & (idxs < len(self.bits))
+        out = np.zeros(len(idxs), dtype=bool)
+        out[ok] = self.bits[idxs[ok]]
+        if self._esparsos:
+            altos = idxs >= SELECAO_BITMAP_MAX_IDX
+            out[altos] = np.isin(idxs[altos], np.fromiter(self._esparsos, dtype=np.int64))
+        return out
+
+    def _separar(self, idxs):
+        """(idx do bitmap, set dos idx altos)."""
+        altos = idxs >= SELECAO_BITMAP_MAX_IDX
+        return idxs[~altos], set(idxs[altos].tolist())
+
+    def marcar(self, idxs):
+        idxs, altos = self._separar(np.unique(self._como_array(idxs)))
+        if altos:
+            self._n += len(altos - self._esparsos)
+            self._esparsos |= altos
+        if len(idxs):
+            self._garantir(int(idxs[-1]))
+            self._n += int(np.count_nonzero(~self.bits[idxs]))
+            self.bits[idxs] = True
+        return self
+
+    def desmarcar(self, idxs):
+        idxs, altos = self._separar(np.unique(self._como_array(idxs)))
+        if altos:
+            self._n -= len(altos & self._esparsos)
+            self._esparsos -= altos
+        idxs = idxs[idxs < len(self.bits)]
+        self._n -= int(np.count_nonzero(self.bits[idxs]))
+        self.bits[idxs] = False
+        return self
+
+    def aplicar_edicao(self, idxs, marcados):
+        """Aplica o estado das caixas visíveis (idx, marcado); devolve quantos itens mudaram."""
+        idxs = pd.to_numeric(pd.Series(idxs), errors="coerce").fillna(-1).to_numpy(dtype=np.int64)
+        marcados = pd.Series(marcados).fillna(False).to_numpy(dtype=bool)
+        ok = idxs >= 0
+        idxs, marcados = idxs[ok], marcados[ok]
+        mudou = self.mascara(idxs) != marcados
+        if not mudou.any():
+            return 0
+        self.marcar(idxs[mudou & marcados])
+        self.desmarcar(idxs[mudou & ~marcados])
+        return int(np.count_nonzero(mudou))
+
+    def manter(self, idxs_validos):
+        """Descarta seleções cujo idx não está mais entre os válidos (ex.: catálogo recarregado)."""
+        arr, altos = self._separar(self._como_array(idxs_validos))
+        validos = np.zeros(len(self.bits), dtype=bool)
+        validos[arr[arr < len(self.bits)]] = True
+        self.bits &= validos
+        self._esparsos &= altos
+        self._n = int(np.count_nonzero(self.bits)) + len(self._esparsos)
+        return self
+
+    def limpar(self):
+        self.bits[:] = False
+        self._esparsos.clear()
+        self._n = 0
+        return self
+
+    def para_bytes(self):
+        """Serialização compacta (1 bit por item do bitmap; os idx altos em seguida, int64)."""
+        return (len(self.bits).to_bytes(8, "little") + np.packbits(self.bits).tobytes() +
+                np.array(sorted(self._esparsos), dtype="<i8").tobytes())
+
+    @classmethod
+    def de_bytes(cls, dados):
+        sel = cls()
+        n = int.from_bytes(dados[:8], "little")
+        fim = 8 + -(-n // 8)
+        sel.bits = np.unpackbits(np.frombuffer(dados[8:fim], dtype=np.uint8), count=n).astype(bool)
+        sel._esparsos = set(np.frombuffer(dados[fim:], dtype="<i8").tolist())
+        sel._n = int(np.count_nonzero(sel.bits)) + len(sel._esparsos)
+        return sel
+
+# ===== Índice de produtos (idx -> linha) =====
+class IndiceProdutos:
+    """
+    Posição no catálogo de cada idx, construída uma vez por versão do catálogo e do diário (derivado "produtos").
+    idx são inteiros pequenos (posição original, preservada por cod), então a tabela é direta: consultar k itens
+    custa O(k), sem varrer nem refazer hash do catálogo a cada rerun. idx esparsos (coluna idx própria na
+    planilha) caem num pd.Index. idx repetido: vale a primeira linha.
+    """
+    __slots__ = ("n", "_tabela", "_hash", "_linhas")
+
+    def __init__(self, df):
+        idx = df["idx"].to_numpy(dtype=np.int64)
+        linhas = np.flatnonzero(~pd.Index(idx).duplicated() & (idx >= 0))
+        self.n = len(df)
+        self._tabela = self._hash = self._linhas = None
+        maior = int(idx[linhas].max()) if len(linhas) else -1
+        if maior < 4 * len(df) + 1024:
+            self._tabela = np.full(maior + 1, -1, dtype=np.int64)
+            self._tabela[idx[linhas]] = linhas
+        else:
+            self._hash, self._linhas = pd.Index(idx[linhas]), linhas
+
+    def posicoes(self, idxs):
+        """Linha de cada idx (-1 = fora do catálogo), na ordem pedida."""
+        idxs = np.asarray(idxs, dtype=np.int64).ravel()
+        if self._tabela is None:
+            achados = self._hash.get_indexer(idxs)
+            return np.where(achados >= 0, self._linhas[np.maximum(achados, 0)], -1)
+        ok = (idxs >= 0) & (idxs < len(self._tabela))
+        out = np.full(len(idxs), -1, dtype=np.int64)
+        out[ok] = self._tabela[idxs[ok]]
+        return out
+
+    def linhas(self, idxs):
+        """Linhas (ordenadas, como no catálogo) dos idx que existem: df.iloc[indice.linhas(...)]."""
+        pos = self.posicoes(idxs)
+        return np.sort(pos[pos >= 0])
+
+    def ausentes(self, idxs):
+        """Os idx que não estão no catálogo (ex.: removidos da planilha)."""
+        idxs = np.asarray(idxs, dtype=np.int64).ravel()
+        return idxs[self.posicoes(idxs) < 0]
+
+# ===== Grade paginada =====
+GRADE_TAMANHOS = [50, 100, 250, 500, 1000]
+GRADE_ORDENACOES = {"Ordem da planilha": None, "Código": "cod", "Descrição": "descricao", "País": "pais",
+                    "Preço base": "preco_base", "Preço venda": "preco_de_venda", "Selecionados primeiro": "selecionado"}
+
+def janela_grade(df, coluna, decrescente, pagina, tamanho, selecao, linhas=None):
+    """
+    Ordena no servidor (argsort estável sobre uma chave numérica) e devolve só a página pedida,
+    sem copiar o restante: (linhas da página, total de páginas).
+    linhas: posições de df que passaram nos filtros (padrão: todas); só a coluna de ordenação é lida.
+    """
+    linhas = np.arange(len(df)) if linhas is None else np.asarray(linhas)
+    n = len(linhas)
+    paginas = max(1, -(-n // tamanho))
+    pagina = min(max(1, int(pagina)), paginas)
+    if coluna is None or n == 0:
+        ordem = np.arange(n)
+    else:
+        if coluna == "selecionado":
+            chave = (~selecao.mascara(df["idx"].to_numpy()[linhas])).astype(np.int8)
+        elif coluna in ("preco_base", "preco_de_venda"):
+            chave = pd.to_numeric(df[coluna].iloc[linhas], errors="coerce").fillna(0).to_numpy(dtype=float)
+        else:
+            texto = _texto_limpo(df[coluna].iloc[linhas])
+            numeros = pd.to_numeric(texto, errors="coerce")
+            if coluna == "cod" and numeros.notna().all():
+                chave = numeros.to_numpy(dtype=float)
+            else:
+                chave, _ = pd.factorize(texto.map(normaliza_texto_busca), sort=True)
+        ordem = np.argsort(chave, kind="stable")
+        if decrescente:
+            ordem = ordem[::-1]
+    ini = (pagina - 1) * tamanho
+    # Índice 0..n-1: com num_rows="dynamic" o data_editor ignora hide_index e mostraria as posições do catálogo
+    return df.iloc[linhas[ordem[ini:ini + tamanho]]].reset_index(drop=True), paginas
+
+# ===== Sugestões salvas (SQLite) =====
+SUGESTOES_DB = os.path.join(SUGESTOES_DIR, "sugestoes.db")
+
+_SCHEMA_SUGESTOES = """
+CREATE TABLE IF NOT EXISTS sugestoes (
+    id INTEGER PRIMARY KEY,
+    nome TEXT NOT NULL UNIQUE,
+    criado_em TEXT NOT NULL,
+    atualizado_em TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sugestao_itens (
+    sugestao_id INTEGER NOT NULL REFERENCES sugestoes(id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    PRIMARY KEY (sugestao_id, idx)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ix_sugestao_itens_idx ON sugestao_itens(idx);
+CREATE TABLE IF NOT EXISTS meta (chave TEXT PRIMARY KEY, valor TEXT);
+"""
+
+def _conexao_sugestoes():
+    """Conexão nova (uma por operação, seguro entre sessões/threads); WAL permite leitores durante a gravação."""
+    os.makedirs(os.path.dirname(SUGESTOES_DB), exist_ok=True)
+    con = sqlite3.connect(SUGESTOES_DB, timeout=15, isolation_level=None)
+    con.execute("PRAGMA foreign_keys = ON")
+    con.execute("PRAGMA busy_timeout = 15000")
+    reg = _registro_processo()
+    if reg.get("sugestoes_db") != SUGESTOES_DB:
+        with reg["lock"]:
+            if reg.get("sugestoes_db") != SUGESTOES_DB:
+                con.execute("PRAGMA journal_mode = WAL")
+                con.executescript(_SCHEMA_SUGESTOES)
+                if con.execute("SELECT valor FROM meta WHERE chave = 'txt_importado'").fetchone() is None:
+                    importar_sugestoes_txt(con)
+                reg["sugestoes_db"] = SUGESTOES_DB
+    return con
+
+def _nova_revisao(con):
+    """Incrementa meta.revisao dentro da transação da gravação: muda a cada escrita, mesmo duas no mesmo segundo."""
+    con.execute("INSERT INTO meta (chave, valor) VALUES ('revisao', 1) "
+                "ON CONFLICT(chave) DO UPDATE SET valor = CAST(valor AS INTEGER) + 1")
+
+def _mesclar(con, nome, idxs):
+    agora = datetime.now().isoformat(timespec="seconds")
+    con.execute("BEGIN IMMEDIATE")
+    try:
+        con.execute("INSERT OR IGNORE INTO sugestoes (nome, criado_em, atualizado_em) VALUES (?, ?, ?)", (nome, agora, agora))
+        con.execute("UPDATE sugestoes SET atualizado_em = ? WHERE nome = ?", (agora, nome))
+        sid = con.execute("SELECT id FROM sugestoes WHERE nome = ?", (nome,)).fetchone()[0]
+        con.executemany("INSERT OR IGNORE INTO sugestao_itens (sugestao_id, idx) VALUES (?, ?)", ((sid, int(i)) for i in idxs))
+        total = con.execute("SELECT COUNT(*) FROM sugestao_itens WHERE sugestao_id = ?", (sid,)).fetchone()[0]
+        _nova_revisao(con)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    return total
+
+def importar_sugestoes_txt(con=None, pasta=SUGESTOES_DIR):
+    """Importação única dos antigos sugestoes/<nome>.txt (mesclando); os arquivos ficam intactos."""
+    propria = con is None
+    con = con or _conexao_sugestoes()
+    try:
+        importadas = 0
+        for fname in sorted(os.listdir(pasta)) if os.path.isdir(pasta) else []:
+            if not fname.endswith(".txt"):
+                continue
+            try:
+                _mesclar(con, fname[:-4], ler_indices_sugestao(os.path.join(pasta, fname)))
+                importadas += 1
+            except (OSError, ValueError):
+                continue
+        con.execute("INSERT OR REPLACE INTO meta (chave, valor) VALUES ('txt_importado', ?)", (datetime.now().isoformat(timespec="seconds"),))
+        return importadas
+    finally:
+        if propria:
+            con.close()
+
+def listar_sugestoes():
+    with closing(_conexao_sugestoes()) as con:
+        return [r[0] for r in con.execute("SELECT nome FROM sugestoes ORDER BY nome")]
+
+def ler_sugestao(nome):
+    """Índices (idx) da sugestão, ordenados; lista vazia se não existir."""
+    with closing(_conexao_sugestoes()) as con:
+        return [r[0] for r in con.execute(
+            "SELECT i.idx FROM sugestao_itens i JOIN sugestoes s ON s.id = i.sugestao_id WHERE s.nome = ? ORDER BY i.idx", (nome,))]
+
+def mesclar_sugestao(nome, idxs):
+    """Cria ou mescla itens na sugestão numa única transação; devolve o total de itens após a mescla."""
+    with closing(_conexao_sugestoes()) as con:
+        return _mesclar(con, nome, idxs)
+
+def excluir_sugestao(nome):
+    with closing(_conexao_sugestoes()) as con:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            excluida = con.execute("DELETE FROM sugestoes WHERE nome = ?", (nome,)).rowcount > 0
+            _nova_revisao(con)
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return excluida
+
+# ===== Análise conjunta das sugestões =====
+def assinatura_sugestoes():
+    """Revisão do banco (meta.revisao, incrementada a cada mescla/exclusão): invalida a matriz de sugestões."""
+    with closing(_conexao_sugestoes()) as con:
+        linha = con.execute("SELECT valor FROM meta WHERE chave = 'revisao'").fetchone()
+        return int(linha[0]) if linha else 0
+
+def construir_matriz_sugestoes(produtos):
+    """
+    Incidência sugestão x produto de todas as sugestões salvas, em CSR como os índices de busca e facetas:
+    as posições no catálogo dos itens da sugestão s ficam em posicoes[offsets[s]:offsets[s+1]], ordenadas.
+    Uma consulta ao banco e uma consulta ao IndiceProdutos para todos os itens; idx fora do catálogo só entram em "ausentes".
+    """
+    with closing(_conexao_sugestoes()) as con:
+        itens = pd.read_sql_query("SELECT s.nome, i.idx FROM sugestoes s "
+                                  "LEFT JOIN sugestao_itens i ON i.sugestao_id = s.id ORDER BY s.nome", con)
+    linha, nomes = pd.factorize(itens["nome"], sort=True)
+    tem_item = itens["idx"].notna().to_numpy()
+    pos = np.full(len(itens), -1, dtype=np.int64)
+    pos[tem_item] = produtos.posicoes(itens["idx"].to_numpy()[tem_item].astype(np.int64))
+    validos = pos >= 0
+    ordem = np.lexsort((pos[validos], linha[validos]))
+    linhas, posicoes = linha[validos][ordem], pos[validos][ordem]
+    return {"nomes": list(nomes), "offsets": np.searchsorted(linhas, np.arange(len(nomes) + 1)),
+            "posicoes": posicoes, "ausentes": np.bincount(linha[tem_item & ~validos], minlength=len(nomes)),
+            "n": produtos.n}
+
+def itens_da_sugestao(matriz, nome):
+    s = matriz["nomes"].index(nome)
+    return matriz["posicoes"][matriz["offsets"][s]:matriz["offsets"][s + 1]]
+
+def frequencia_sugestoes(matriz):
+    """Em quantas sugestões aparece cada posição do catálogo."""
+    return np.bincount(matriz["posicoes"], minlength=matriz["n"])
+
+def contagem_por_sugestao(matriz, marcados):
+    """Quantos itens de cada sugestão estão na máscara de posições (uma passada pelo CSR)."""
+    acumulado = np.concatenate([[0], np.cumsum(marcados[matriz["posicoes"]], dtype=np.int64)])
+    return acumulado[matriz["offsets"][1:]] - acumulado[matriz["offsets"][:-1]]
+
+def sobreposicao_sugestoes(matriz, nome):
+    """Itens em comum (e índice de Jaccard) entre a sugestão `nome` e cada uma das outras."""
+    marcados = np.zeros(matriz["n"], dtype=bool)
+    marcados[itens_da_sugestao(matriz, nome)] = True
+    comuns = contagem_por_sugestao(matriz, marcados)
+    tamanhos = np.diff(matriz["offsets"])
+    uniao = tamanhos + int(marcados.sum()) - comuns
+    tabela = pd.DataFrame({"sugestao": matriz["nomes"], "itens": tamanhos, "em_comum": comuns,
+                           "jaccard": np.round(comuns / np.maximum(uniao, 1), 3)})
+    return tabela[tabela["sugestao"] != nome].sort_values(["em_comum", "jaccard"], ascending=False, kind="stable")
+
+# ===== Índice de imagens =====
+def _escanear_imagens(raiz):
+    """Uma passada de scandir: código exato -> melhor arquivo, e nomes ordenados para busca por prefixo."""
+    exatos, nomes = {}, []
+    try:
+        with os.scandir(raiz) as it:
+            for entrada in it:
+                if not entrada.is_file():
+                    continue
+                stem, ext = os.path.splitext(entrada.name)
+                ext = ext.lower()
+                if ext not in IMAGEM_EXTS:
+                    continue
+                path = os.path.abspath(entrada.path)
+                rank = IMAGEM_EXTS.index(ext)
+                if stem not in exatos or rank < exatos[stem][0]:
+                    exatos[stem] = (rank, path)
+                nomes.append((entrada.name, path))
+    except OSError:
         pass
+    nomes.sort()
+    return {"exatos": {k: v[1] for k, v in exatos.items()}, "nomes": nomes}
+
+def indice_imagens():
+    """Índice das pastas de IMAGEM_DIRS, compartilhado pelo processo; só reescaneia a pasta cujo mtime mudou."""
+    reg = _registro_processo()
+    with reg["lock"]:
+        ind = reg.setdefault("imagens", {"raizes": {}, "exatos": {}, "verificado": None})
+        agora = time.monotonic()
+        if ind["verificado"] is not None and agora - ind["verificado"] < IMAGEM_INDICE_TTL:
+            return ind
+        ind["verificado"] = agora
+        mudou = False
+        for raiz in IMAGEM_DIRS:
+            try:
+                mtime = os.stat(raiz).st_mtime_ns
+            except OSError:
+                mtime = None
+            atual = ind["raizes"].get(raiz)
+            if atual is not None and atual["mtime"] == mtime:
+                continue
+            dados = _escanear_imagens(raiz) if mtime is not None else {"exatos": {}, "nomes": []}
+            dados["mtime"] = mtime
+            ind["raizes"][raiz] = dados
+            mudou = True
+        if mudou:
+            exatos = {}
+            for raiz in reversed(IMAGEM_DIRS):
+                exatos.update(ind["raizes"][raiz]["exatos"])
+            ind["exatos"] = exatos
+        return ind
+
+def get_imagem_file(cod: str):
+    cod = str(cod).strip()
+    if not cod:
+        return None
+    ind = indice_imagens()
+    path = ind["exatos"].get(cod)
+    if path:
+        return path
+    # Compatibilidade: arquivo cujo nome apenas começa pelo código (ex.: "3229_frente.jpg")
+    for raiz in IMAGEM_DIRS:
+        nomes = ind["raizes"].get(raiz, {}).get("nomes", [])
+        i = bisect.bisect_left(nomes, (cod,))
+        if i < len(nomes) and nomes[i][0].startswith(cod):
+            return nomes[i][1]
     return None
 
-def atualiza_coluna_preco_base(df: pd.DataFrame, flag: str, fator_global: float):
-    base = df[flag] if flag in df.columns else df.get("preco1", 0.0)
-    df["preco_base"] = to_float_series(base, default=0.0)
-    if "fator" not in df.columns:
-        df["fator"] = fator_global
-    df["fator"] = to_float_series(df["fator"], default=fator_global)
-    df["fator"] = df["fator"].apply(lambda x: fator_global if pd.isna(x) or x <= 0 else x)
-    df["preco_de_venda"] = (df["preco_base"].astype(float) * df["fator"].astype(float)).astype(float)
+# ===== Cache de miniaturas =====
+def _podar_miniaturas(reg):
+    """Remove as miniaturas menos usadas (mtime mais antigo) até ficar abaixo de 80% do limite."""
+    try:
+        entradas = []
+        with os.scandir(MINIATURA_DIR) as it:
+            for e in it:
+                if e.is_file():
+                    info = e.stat()
+                    entradas.append((info.st_mtime, info.st_size, e.path))
+    except OSError:
+        return
+    total = sum(e[1] for e in entradas)
+    if total > MINIATURA_CACHE_MAX_BYTES:
+        for _, tamanho, path in sorted(entradas):
+            try:
+                os.remove(path)
+                total -= tamanho
+            except OSError:
+                pass
+            if total <= MINIATURA_CACHE_MAX_BYTES * 0.8:
+                break
+    reg["miniaturas_bytes"] = total
+
+def miniatura_imagem(path, largura, altura):
+    """
+    Caminho de uma cópia reduzida e recomprimida da foto para exibição em largura x altura.
+    Chave = hash de (caminho, mtime, tamanho) da origem + tamanho alvo; em caso de falha devolve o original.
+    """
+    try:
+        info = os.stat(path)
+    except OSError:
+        return path
+    origem = f"{os.path.abspath(path)}|{info.st_mtime_ns}|{info.st_size}"
+    chave = f"{hashlib.sha1(origem.encode()).hexdigest()[:24]}_{largura}x{altura}"
+    reg = _registro_processo()
+    memoria = reg.setdefault("miniaturas", {})
+    destino = memoria.get(chave)
+    if destino and os.path.exists(destino):
+        return destino
+    for ext in (".jpg", ".png"):
+        candidato = os.path.join(MINIATURA_DIR, chave + ext)
+        if os.path.exists(candidato):
+            try:
+                os.utime(candidato)  # Marca como usada recentemente para a poda
+            except OSError:
+                pass
+            memoria[chave] = candidato
+            return candidato
+    try:
+        os.makedirs(MINIATURA_DIR, exist_ok=True)
+        alvo = (largura * MINIATURA_ESCALA, altura * MINIATURA_ESCALA)
+        with Image.open(path) as img:
+            img.draft("RGB", alvo)  # JPEG já decodifica reduzido
+            img.thumbnail(alvo)
+            if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+                destino = os.path.join(MINIATURA_DIR, chave + ".png")
+                img, formato, opcoes = img.convert("RGBA"), "PNG", {"optimize": True}
+            else:
+                destino = os.path.join(MINIATURA_DIR, chave + ".jpg")
+                img, formato, opcoes = img.convert("RGB"), "JPEG", {"quality": 85, "optimize": True}
+            tmp = f"{destino}.{os.getpid()}.{threading.get_ident()}.tmp"
+            img.save(tmp, formato, **opcoes)
+        os.replace(tmp, destino)
+    except Exception:
+        return path
+    memoria[chave] = destino
+    with reg["lock"]:
+        if "miniaturas_bytes" not in reg:
+            _podar_miniaturas(reg)
+        else:
+            reg["miniaturas_bytes"] += os.path.getsize(destino)
+            if reg["miniaturas_bytes"] > MINIATURA_CACHE_MAX_BYTES:
+                _podar_miniaturas(reg)
+    return destino
+
+# ===== Matriz de preços (todas as tabelas) =====
+def construir_matriz_precos(df):
+    """
+    Preço base de todas as TABELAS_PRECO numa matriz linhas x tabelas (colunas contíguas) e o fator da planilha,
+    convertidos uma vez por versão do catálogo: trocar de tabela vira uma visão de coluna.
+    """
+    n = len(df)
+    padrao = to_float_series(df["preco1"], default=0.0).to_numpy(dtype=float) if "preco1" in df.columns else np.zeros(n)
+    base = np.empty((n, len(TABELAS_PRECO)), dtype=float, order="F")
+    for j, tabela in enumerate(TABELAS_PRECO):
+        base[:, j] = to_float_series(df[tabela], default=0.0).to_numpy(dtype=float) if tabela in df.columns else padrao
+    fator = to_float_series(df["fator"], default=np.nan).to_numpy(dtype=float) if "fator" in df.columns else np.full(n, np.nan)
+    return {"tabelas": list(TABELAS_PRECO), "base": base, "fator": fator, "n": n}
+
+def fator_efetivo(matriz, fator_global):
+    """Fator da planilha, com o fator global onde estiver vazio ou <= 0."""
+    fator = matriz["fator"]
+    return np.where(np.isnan(fator) | (fator <= 0), float(fator_global), fator)
+
+def aplicar_tabela(df, matriz, tabela, fator_global):
+    """
+    preco_base (da tabela escolhida), fator efetivo e preco_de_venda = base x fator para o catálogo da matriz
+    (mesmas linhas, mesma ordem).
+    Linhas além das da matriz (diário de cadastros) mantêm o preço, o fator e o preço de venda cadastrados.
+    """
+    n = matriz["n"]
+    base = matriz["base"][:, matriz["tabelas"].index(tabela)]
+    fator = fator_efetivo(matriz, fator_global)
+    venda = base * fator
+    if len(df) > n:
+        extra = lambda c: to_float_series(df[c].iloc[n:], default=0.0).to_numpy(dtype=float)
+        base, fator, venda = (np.concatenate([v, extra(c)]) for v, c in
+                              ((base, "preco_base"), (fator, "fator"), (venda, "preco_de_venda")))
+    df["preco_base"] = base
+    df["fator"] = fator
+    df["preco_de_venda"] = venda
+    return df
+
+def comparar_tabelas(matriz, posicoes, fator):
+    """Preço de venda de cada tabela (base x fator) para as linhas do catálogo em posicoes; fator por linha."""
+    venda = matriz["base"][posicoes] * np.asarray(fator, dtype=float)[:, None]
+    return pd.DataFrame(venda, columns=matriz["tabelas"])
+
+# ===== Precificação (ajustes manuais) =====
+def _ajustes_para_arrays(produtos, ajustes):
+    """(posições, valores) dos ajustes {idx: valor} cujo idx está no catálogo."""
+    if not ajustes:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=float)
+    pos = produtos.posicoes([int(k) for k in ajustes])
+    valores = np.array([float(v) for v in ajustes.values()], dtype=float)
+    ok = pos >= 0
+    return pos[ok], valores[ok]
+
+def precificar(df, fator_global, manual_fat, manual_preco_venda, produtos=None):
+    """
+    Aplica os ajustes manuais de fator e de preço de venda sobre as colunas de aplicar_tabela (novas a cada
+    rerun). Só as linhas com ajuste são recalculadas, por posição (idx -> linha via IndiceProdutos; passe o do
+    catálogo para não reconstruí-lo). Altera df e o devolve.
+    """
+    produtos = produtos or IndiceProdutos(df)
+    pos_fat, fatores = _ajustes_para_arrays(produtos, manual_fat)
+    pos_pv, vendas = _ajustes_para_arrays(produtos, manual_preco_venda)
+    if not len(pos_fat) and not len(pos_pv):
+        return df
+    pv = df["preco_de_venda"].to_numpy(dtype=float, copy=True)
+    if len(pos_fat):
+        fator = df["fator"].to_numpy(dtype=float, copy=True)
+        fator[pos_fat] = np.where(np.isnan(fatores) | (fatores <= 0), float(fator_global), fatores)
+        pv[pos_fat] = df["preco_base"].to_numpy(dtype=float)[pos_fat] * fator[pos_fat]
+        df["fator"] = fator
+    pv[pos_pv] = vendas
+    df["preco_de_venda"] = pv
     return df
 
 def normaliza_tipo(t):
@@ -153,199 +1288,899 @@ def normaliza_tipo(t):
     if "licor" in t: return "Licorosos"
     return t.title()
 
-def ordenar_para_saida(df):
-    tipos_norm = df.get("tipo", pd.Series([""]*len(df))).astype(str).map(normaliza_tipo)
-    ordem_map = {t: i for i, t in enumerate(TIPO_ORDEM_FIXA)}
-    ordem = tipos_norm.map(lambda x: ordem_map.get(x, 999))
-    df2 = df.copy()
-    df2["__tipo_ordem"] = ordem
-    cols_exist = [c for c in ["__tipo_ordem","pais","descricao"] if c in df2.columns]
-    return df2.sort_values(cols_exist).drop(columns=["__tipo_ordem"], errors="ignore")
+def tipo_normalizado(tipos):
+    """
+    Seção de cada linha como category ordenada: TIPO_ORDEM_FIXA primeiro, depois os demais tipos em ordem
+    alfabética. normaliza_tipo roda uma vez por valor distinto; calculada na carga do catálogo (coluna tipo_norm).
+    """
+    tipos = _texto_limpo(tipos)
+    mapa = {t: normaliza_tipo(t) for t in pd.unique(tipos)}
+    outros = sorted(set(mapa.values()) - set(TIPO_ORDEM_FIXA))
+    return pd.Series(pd.Categorical(tipos.map(mapa), categories=TIPO_ORDEM_FIXA + outros, ordered=True), index=tipos.index)
+
+def _secoes_tipo(df):
+    """Seção (tipo_norm) e sua posição em TIPO_ORDEM_FIXA (999 = fora da lista), pelos códigos da category."""
+    secao = df["tipo_norm"] if "tipo_norm" in df.columns else None
+    if secao is None or not isinstance(secao.dtype, pd.CategoricalDtype) or list(secao.cat.categories[:len(TIPO_ORDEM_FIXA)]) != TIPO_ORDEM_FIXA:
+        secao = tipo_normalizado(df["tipo"] if "tipo" in df.columns else pd.Series([""] * len(df), index=df.index))
+    codigos = secao.cat.codes.to_numpy().astype(np.int64)
+    return secao, pd.Series(np.where(codigos < len(TIPO_ORDEM_FIXA), codigos, 999), index=secao.index)
+
+def contagem_tipos(secao):
+    """{tipo de TIPO_ORDEM_FIXA ou 'outros': quantidade}, por value_counts da seção categórica."""
+    n = secao.value_counts(sort=False)
+    contagem = {t: int(n.get(t, 0)) for t in TIPO_ORDEM_FIXA}
+    contagem["outros"] = int(len(secao) - sum(contagem.values()))
+    return contagem
 
-def add_pdf_footer(c, contagem, total_rotulos, fator_geral):
+def ordenar_para_saida(df):
+    """Ordena por tipo (ordem fixa), país e descrição; só as colunas de ordenação são copiadas."""
+    _, ordem = _secoes_tipo(df)
+    chaves = df[[c for c in ["pais","descricao"] if c in df.columns]].reset_index(drop=True)
+    chaves.insert(0, "__tipo_ordem", ordem.to_numpy())
+    return df.iloc[chaves.sort_values(list(chaves.columns)).index.to_numpy()]
+
+# ===== Modelo da carta (pré-visualização, PDF e Excel) =====
+COLUNAS_CARTA = ["idx","cod","descricao","pais","regiao","tipo","uva1","uva2","uva3","amadurecimento","preco_base","preco_de_venda","fator"]
+
+def _cod_texto(cod):
+    if not cod:
+        return ""
+    try:
+        return str(int(float(cod)))
+    except ValueError:
+        return cod
+
+def _texto_reais(serie):
+    valores = pd.to_numeric(serie, errors="coerce")
+    return ["R$ -" if pd.isna(v) else f"R$ {v:.2f}" for v in valores]
+
+def montar_carta(df, inserir_foto=False):
+    """
+    Modelo único da carta: seções (tipo normalizado) -> países -> itens já formatados.
+    Uma ordenação e uma passada de agrupamento; pré-visualização, PDF e Excel só desenham.
+    """
+    d = df.reset_index(drop=True)
+    vazio = pd.Series([""] * len(d), dtype=object)
+    col = lambda c: _texto_limpo(d[c]) if c in d.columns else vazio
+    secao, ordem = _secoes_tipo(d)
+    chaves = pd.DataFrame({"ordem": ordem, "secao": secao, "pais": col("pais"), "descricao": col("descricao")})
+    pos = chaves.sort_values(["ordem", "secao", "pais", "descricao"], kind="stable").index.to_numpy()
+    colunas = {c: col(c).to_numpy()[pos] for c in ["cod","descricao","pais","regiao","uva1","uva2","uva3","amadurecimento"]}
+    colunas["secao"] = secao.to_numpy()[pos]
+    colunas["idx"] = d["idx"].to_numpy()[pos] if "idx" in d.columns else pos
+    colunas["preco_base"] = np.asarray(_texto_reais(d["preco_base"]) if "preco_base" in d.columns else ["R$ -"] * len(d), dtype=object)[pos]
+    colunas["preco_de_venda"] = np.asarray(_texto_reais(d["preco_de_venda"]) if "preco_de_venda" in d.columns else ["R$ -"] * len(d), dtype=object)[pos]
+
+    secoes = []
+    for ordem_geral, linha in enumerate(zip(*(colunas[c] for c in ["secao","pais","idx","cod","descricao","regiao","uva1","uva2","uva3","amadurecimento","preco_base","preco_de_venda"])), start=1):
+        sec, pais, idx, cod, desc, regiao, u1, u2, u3, amad, pb, pv = linha
+        if not secoes or secoes[-1]["tipo"] != sec:
+            secoes.append({"tipo": sec, "inicio": ordem_geral, "paises": []})
+        paises = secoes[-1]["paises"]
+        if not paises or paises[-1]["pais"] != pais:
+            paises.append({"pais": pais, "itens": []})
+        uvas = [u for u in (u1, u2, u3) if u]
+        regiao_str = f"{pais} | {regiao}"
+        if uvas: regiao_str += f" | {', '.join(uvas)}"
+        cod_txt = _cod_texto(cod)
+        paises[-1]["itens"].append({
+            "ordem": ordem_geral, "idx": idx, "cod": cod_txt, "descricao": desc, "regiao_str": regiao_str,
+            "uvas": uvas, "amadurecimento": bool(amad), "preco_base": pb, "preco_de_venda": pv,
+            "foto": get_imagem_file(cod_txt) if inserir_foto and cod_txt else None,
+        })
+
+    fator = pd.to_numeric(d["fator"], errors="coerce").median() if "fator" in d.columns and len(d) else 0.0
+    return {"secoes": secoes, "contagem": contagem_tipos(secao), "total": len(d), "fator_geral": 0.0 if pd.isna(fator) else float(fator)}
+
+def carta_da_selecao(df_sel, inserir_foto):
+    """montar_carta com cache na sessão, pela assinatura do conteúdo selecionado (itens, preços, fator)."""
+    colunas = [c for c in COLUNAS_CARTA if c in df_sel.columns]
+    try:
+        chave = (int(pd.util.hash_pandas_object(df_sel[colunas], index=False).sum()), len(df_sel), bool(inserir_foto))
+    except TypeError:
+        return montar_carta(df_sel, inserir_foto)
+    cache = st.session_state.get("carta_cache")
+    if cache and cache[0] == chave:
+        return cache[1]
+    carta = montar_carta(df_sel, inserir_foto)
+    st.session_state.carta_cache = (chave, carta)
+    return carta
+
+def contagem_ate(carta, ordem):
+    """Contagem por tipo dos itens 1..ordem (rodapé de cada página), pelo início de cada seção na carta."""
+    contagem = dict.fromkeys(carta["contagem"], 0)
+    for i, secao in enumerate(carta["secoes"]):
+        fim = carta["secoes"][i + 1]["inicio"] if i + 1 < len(carta["secoes"]) else carta["total"] + 1
+        tipo = secao["tipo"] if secao["tipo"] in contagem else "outros"
+        contagem[tipo] += max(0, min(fim, ordem + 1) - secao["inicio"])
+    return contagem
+
+PDF_PAGINAS_POR_PARTE = 25  # gerar_pdf em arquivo: páginas mantidas pelo ReportLab antes de salvar a parte
+
+def _formularios_pdf(c, titulo, cliente, logo_cliente_bytes, gerado_em):
+    """
+    Cabeçalho (logos, título, cliente) e partes fixas do rodapé como Form XObjects: desenhados uma vez por
+    documento e só referenciados em cada página; cada logo é lido e embutido uma única vez.
+    """
     width, height = A4
+    c.beginForm("cabecalho")
+    if logo_cliente_bytes:
+        try:
+            c.drawImage(ImageReader(io.BytesIO(logo_cliente_bytes)), 40, height-60, width=120, height=40, mask='auto')
+        except Exception:
+            pass
+    if os.path.exists(LOGO_PADRAO):
+        try:
+            c.drawImage(LOGO_PADRAO, width-80, height-40, width=48, height=24, mask='auto')
+        except Exception:
+            pass
+    c.setFont("Helvetica-Bold", 16)
+    c.drawCentredString(width/2, height-40, titulo)
+    if cliente:
+        c.setFont("Helvetica", 10)
+        c.drawCentredString(width/2, height-60, f"Cliente: {cliente}")
+    c.endForm()
+
     y_rodape = 35
-    now = datetime.now().strftime("%d/%m/%Y %H:%M")
+    c.beginForm("rodape")
     c.setLineWidth(0.4)
     c.line(30, y_rodape+32, width-30, y_rodape+32)
     c.setFont("Helvetica", 5)
-    c.drawString(32, y_rodape+20, f"Gerado em: {now}")
+    c.drawString(32, y_rodape+20, f"Gerado em: {gerado_em}")
+    c.drawString(32, y_rodape-5, "Ingá Distribuidora Ltda | CNPJ 05.390.477/0002-25 Rod BR 232, KM 18,5 - S/N- Manassu - CEP 54130-340 Jaboatão")
+    c.setFont("Helvetica-Bold", 6)
+    c.drawString(width-190, y_rodape-5, "b2b.ingavinhos.com.br")
+    c.endForm()
+
+def add_pdf_footer(c, contagem, total_rotulos, fator_geral):
+    """Rodapé da página: o formulário fixo de _formularios_pdf mais a linha de contagens (única parte variável)."""
+    c.doForm("rodape")
     try:
         fator_str = f"{float(fator_geral):.2f}"
     except Exception:
         fator_str = str(fator_geral)
     c.setFont("Helvetica-Bold", 6)
-    c.drawString(32, y_rodape+7,
+    c.drawString(32, 42,
         f"Espumantes: {contagem.get('Espumantes',0)} | Frisantes: {contagem.get('Frisantes',0)} | "
         f"Brancos: {contagem.get('Vinhos Brancos',0)} | Rosés: {contagem.get('Vinhos Rosés',0)} | "
         f"Tintos: {contagem.get('Vinhos Tintos',0)} | Fortificados: {contagem.get('Fortificados',0)} | "
         f"Sobremesas: {contagem.get('Vinhos Sobremesas',0)} | Licorosos: {contagem.get('Licorosos',0)} | "
         f"Total: {int(total_rotulos)} | Fator: {fator_str}")
-    c.setFont("Helvetica", 5)
-    c.drawString(32, y_rodape-5, "Ingá Distribuidora Ltda | CNPJ 05.390.477/0002-25 Rod BR 232, KM 18,5 - S/N- Manassu - CEP 54130-340 Jaboatão")
-    c.setFont("Helvetica-Bold", 6)
-    c.drawString(width-190, y_rodape-5, "b2b.ingavinhos.com.br")
 
-def gerar_pdf(df, titulo, cliente, inserir_foto, logo_cliente_bytes=None):
-    buffer = io.BytesIO()
-    c = canvas.Canvas(buffer, pagesize=A4)
+_RE_PDF_REF = re.compile(rb"(?<![\d.])(\d+) 0 R\b")
+_RE_PDF_XREF = re.compile(rb"(\d{10}) \d{5} ([nf])")
+_RE_PDF_STREAM = re.compile(rb">>\s*stream\r?\n")
+
+def _unir_pdfs(partes, destino):
+    """
+    Concatena os PDFs das partes (saída do ReportLab: xref clássico, sem object streams) em destino.
+    Os objetos de cada parte são copiados com a numeração deslocada (conteúdo dos streams intacto); só uma
+    parte fica em memória por vez. Objetos 1 e 2 (árvore de páginas e catálogo) são gravados no fim.
+    """
+    tmp = f"{destino}.{os.getpid()}.tmp"
+    posicoes, paginas = {}, []
+    proximo = 3
+    with open(tmp, "wb") as saida:
+        saida.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        for parte in partes:
+            with open(parte, "rb") as f:
+                dados = f.read()
+            inicio_xref = int(re.findall(rb"startxref\s+(\d+)", dados)[-1])
+            fim_xref = dados.index(b"trailer", inicio_xref)
+            entradas = _RE_PDF_XREF.findall(dados, inicio_xref, fim_xref)
+            inicios = {num: int(pos) for num, (pos, tipo) in enumerate(entradas) if tipo == b"n"}
+            ordenados = sorted(inicios.items(), key=lambda e: e[1])
+            fins = {num: fim for (num, _), (_, fim) in zip(ordenados, [*ordenados[1:], (None, inicio_xref)])}
+            trailer = dados[fim_xref:]
+            raiz = int(re.search(rb"/Root (\d+) 0 R", trailer).group(1))
+            info = re.search(rb"/Info (\d+) 0 R", trailer)
+            arvore = int(re.search(rb"/Pages (\d+) 0 R", dados[inicios[raiz]:fins[raiz]]).group(1))
+            descartar = {raiz, arvore} | ({int(info.group(1))} if info else set())
+            novo = {num: proximo + i for i, num in enumerate(n for n in sorted(inicios) if n not in descartar)}
+            novo[arvore] = 1
+            proximo += len(inicios) - len(descartar)
+            renumerar = lambda trecho: _RE_PDF_REF.sub(lambda m: b"%d 0 R" % novo.get(int(m.group(1)), 0), trecho)
+            kids = re.search(rb"/Kids\s*\[([^\]]*)\]", dados[inicios[arvore]:fins[arvore]]).group(1)
+            paginas.extend(novo[int(k)] for k in _RE_PDF_REF.findall(kids))
+            for num in sorted(inicios):
+                if num in descartar:
+                    continue
+                obj = dados[inicios[num]:fins[num]]
+                corpo = obj[obj.index(b"obj") + 3:]
+                m = _RE_PDF_STREAM.search(corpo)
+                corpo = renumerar(corpo[:m.end()]) + corpo[m.end():] if m else renumerar(corpo)
+                posicoes[novo[num]] = saida.tell()
+                saida.write(b"%d 0" % novo[num] + b" obj" + corpo)
+            del dados
+        posicoes[1] = saida.tell()
+        saida.write(b"1 0 obj\n<< /Count %d /Kids [ %s ] /Type /Pages >>\nendobj\n"
+                    % (len(paginas), b" ".join(b"%d 0 R" % n for n in paginas)))
+        posicoes[2] = saida.tell()
+        saida.write(b"2 0 obj\n<< /Pages 1 0 R /Type /Catalog >>\nendobj\n")
+        inicio_xref = saida.tell()
+        saida.write(b"xref\n0 %d\n0000000000 65535 f \n" % proximo)
+        saida.writelines(b"%010d 00000 n \n" % posicoes.get(n, 0) for n in range(1, proximo))
+        saida.write(b"trailer\n<< /Root 2 0 R /Size %d >>\nstartxref\n%d\n%%%%EOF\n" % (proximo, inicio_xref))
+    os.replace(tmp, destino)
+
+def gerar_pdf(carta, titulo, cliente, inserir_foto, logo_cliente_bytes=None, progresso=None, destino=None):
+    """
+    progresso(itens desenhados, total, páginas) é chamado a cada item; pode levantar exceção para cancelar.
+    Sem destino devolve um BytesIO. Com destino (caminho) grava em disco e devolve o caminho: o canvas é fechado
+    a cada PDF_PAGINAS_POR_PARTE páginas (o ReportLab só libera a memória ao salvar) e as partes são unidas
+    no fim, então o pico de memória não cresce com o tamanho da carta.
+    """
+    if isinstance(carta, pd.DataFrame):
+        carta = montar_carta(carta, inserir_foto)
     width, height = A4
-
-    if logo_cliente_bytes:
-        try:
-            c.drawImage(ImageReader(io.BytesIO(logo_cliente_bytes)), 40, height-60, width=120, height=40, mask='auto')
-        except Exception:
-            pass
-    if os.path.exists(LOGO_PADRAO):
-        try:
-            c.drawImage(LOGO_PADRAO, width-80, height-40, width=48, height=24, mask='auto')
-        except Exception:
-            pass
-
-    x_texto = 90
-    y = height - 40
-    c.setFont("Helvetica-Bold", 16)
-    c.drawCentredString(width/2, y, titulo)
-    y -= 20
-    if cliente:
-        c.setFont("Helvetica", 10)
-        c.drawCentredString(width/2, y, f"Cliente: {cliente}")
-        y -= 20
-
-    ordem_geral = 1
-    contagem = {
-        'Espumantes': 0, 'Frisantes': 0, 'Vinhos Brancos': 0, 'Vinhos Rosés': 0,
-        'Vinhos Tintos': 0, 'Fortificados': 0, 'Vinhos Sobremesas': 0, 'Licorosos': 0, 'outros': 0
-    }
-    df_sorted = ordenar_para_saida(df)
-
-    for tipo in df_sorted['tipo'].fillna("").astype(str).unique():
-        tipo_norm = normaliza_tipo(tipo)
-        c.setFont("Helvetica-Bold", 10)
-        c.drawString(x_texto, y, tipo_norm.upper()); y -= 14
-        for pais in df_sorted[df_sorted['tipo']==tipo]['pais'].dropna().unique():
-            c.setFont("Helvetica-Bold", 8)
-            c.drawString(x_texto, y, str(pais).upper()); y -= 12
-            grupo = df_sorted[(df_sorted['tipo']==tipo) & (df_sorted['pais']==pais)]
-            for _, row in grupo.iterrows():
-                t = str(tipo).lower()
-                if "espum" in t: contagem["Espumantes"] += 1
-                elif "fris" in t: contagem["Frisantes"] += 1
-                elif "branc" in t: contagem["Vinhos Brancos"] += 1
-                elif "ros" in t: contagem["Vinhos Rosés"] += 1
-                elif "tint" in t: contagem["Vinhos Tintos"] += 1
-                elif "forti" in t: contagem["Fortificados"] += 1
-                elif "sobrem" in t: contagem["Vinhos Sobremesas"] += 1
-                elif "licor" in t: contagem["Licorosos"] += 1
-                else: contagem["outros"] += 1
-
-                c.setFont("Helvetica", 6)
-                try: codtxt = f"{int(row['cod'])}"
-                except Exception: codtxt = str(row.get('cod',""))
-                c.drawString(x_texto, y, f"{ordem_geral:02d} ({codtxt})")
-                c.setFont("Helvetica-Bold", 7)
-                c.drawString(x_texto+55, y, str(row['descricao']))
-                uvas = [str(row.get(f"uva{i}", "")).strip() for i in range(1,4)]
-                uvas = [u for u in uvas if u and u.lower() != "nan"]
-                regiao_str = f"{row.get('pais','')} | {row.get('regiao','')}"
-                if uvas: regiao_str += f" | {', '.join(uvas)}"
-                c.setFont("Helvetica", 5); c.drawString(x_texto+55, y-10, regiao_str)
-
-                amad = str(row.get("amadurecimento", ""))
-                if amad and amad.lower() != "nan":
-                    c.setFont("Helvetica", 7); c.drawString(220, y-7, "🛢️")
-
-                c.setFont("Helvetica", 5)
-                try: c.drawRightString(width-120, y, f"(R$ {float(row['preco_base']):.2f})")
-                except Exception: c.drawRightString(width-120, y, "(R$ -)")
-                c.setFont("Helvetica-Bold", 7)
-                try: c.drawRightString(width-40, y, f"R$ {float(row['preco_de_venda']):.2f}")
-                except Exception: c.drawRightString(width-40, y, "R$ -")
-
-                if inserir_foto:
-                    imgfile = get_imagem_file(str(row.get('cod','')))
-                    if imgfile:
-                        try:
-                            c.drawImage(imgfile, x_texto+340, y-2, width=40, height=30, mask='auto'); y -= 28
-                        except Exception: y -= 20
+    gerado_em = datetime.now().strftime("%d/%m/%Y %H:%M")
+    por_parte = PDF_PAGINAS_POR_PARTE if destino else 0
+    partes = []
+
+    def abrir_canvas():
+        if por_parte:
+            partes.append(f"{destino}.parte{len(partes)}.{os.getpid()}.tmp")
+        c = canvas.Canvas(partes[-1] if por_parte else (destino or buffer), pagesize=A4)
+        _formularios_pdf(c, titulo, cliente, logo_cliente_bytes, gerado_em)
+        c.doForm("cabecalho")
+        return c
+
+    buffer = None if destino else io.BytesIO()
+    paginas_salvas = 0
+    try:
+        c = abrir_canvas()
+        x_texto = 90
+        y = y_inicio = height - 60 - (20 if cliente else 0)
+
+        for secao in carta["secoes"]:
+            c.setFont("Helvetica-Bold", 10)
+            c.drawString(x_texto, y, secao["tipo"].upper()); y -= 14
+            for grupo in secao["paises"]:
+                c.setFont("Helvetica-Bold", 8)
+                c.drawString(x_texto, y, grupo["pais"].upper()); y -= 12
+                for item in grupo["itens"]:
+                    c.setFont("Helvetica", 6)
+                    c.drawString(x_texto, y, f"{item['ordem']:02d} ({item['cod']})")
+                    c.setFont("Helvetica-Bold", 7)
+                    c.drawString(x_texto+55, y, item["descricao"])
+                    c.setFont("Helvetica", 5); c.drawString(x_texto+55, y-10, item["regiao_str"])
+
+                    if item["amadurecimento"]:
+                        c.setFont("Helvetica", 7); c.drawString(220, y-7, "🛢️")
+
+                    c.setFont("Helvetica", 5)
+                    c.drawRightString(width-120, y, f"({item['preco_base']})")
+                    c.setFont("Helvetica-Bold", 7)
+                    c.drawRightString(width-40, y, item["preco_de_venda"])
+
+                    if inserir_foto:
+                        if item["foto"]:
+                            try:
+                                c.drawImage(miniatura_imagem(item["foto"], 40, 30), x_texto+340, y-2, width=40, height=30, mask='auto'); y -= 28
+                            except Exception: y -= 20
+                        else:
+                            y -= 20
                     else:
                         y -= 20
-                else:
-                    y -= 20
-
-                ordem_geral += 1
-
-                if y < 100:
-                    add_pdf_footer(c, contagem, ordem_geral-1, fator_geral=df.get('fator', pd.Series([0])).median())
-                    c.showPage()
-                    y = height - 40
-                    if logo_cliente_bytes:
-                        try: c.drawImage(ImageReader(io.BytesIO(logo_cliente_bytes)), 40, height-60, width=120, height=40, mask='auto')
-                        except Exception: pass
-                    if os.path.exists(LOGO_PADRAO):
-                        try: c.drawImage(LOGO_PADRAO, width-80, height-40, width=48, height=24, mask='auto')
-                        except Exception: pass
-                    c.setFont("Helvetica-Bold", 16); c.drawCentredString(width/2, y, titulo); y -= 20
-                    if cliente: c.setFont("Helvetica", 10); c.drawCentredString(width/2, y, f"Cliente: {cliente}"); y -= 20
-        y -= 10  # Espaço extra entre seções de tipo
-
-    add_pdf_footer(c, contagem, ordem_geral-1, fator_geral=df.get('fator', pd.Series([0])).median())
-    c.save(); buffer.seek(0)
+
+                    if y < 100:
+                        add_pdf_footer(c, contagem_ate(carta, item["ordem"]), item["ordem"], fator_geral=carta["fator_geral"])
+                        if por_parte and c.getPageNumber() >= por_parte:
+                            paginas_salvas += c.getPageNumber()
+                            c.save()
+                            c = abrir_canvas()
+                        else:
+                            c.showPage()
+                            c.doForm("cabecalho")
+                        y = y_inicio
+                    if progresso:
+                        progresso(item["ordem"], carta["total"], paginas_salvas + c.getPageNumber())
+            y -= 10  # Espaço extra entre seções de tipo
+
+        add_pdf_footer(c, carta["contagem"], carta["total"], fator_geral=carta["fator_geral"])
+        c.save()
+        if partes:
+            _unir_pdfs(partes, destino)
+    finally:
+        for parte in partes:
+            try:
+                os.remove(parte)
+            except OSError:
+                pass
+    if destino:
+        return destino
+    buffer.seek(0)
     return buffer
 
-def exportar_excel_like_pdf(df, inserir_foto=True):
+def exportar_excel_like_pdf(carta, inserir_foto=True, progresso=None):
+    if isinstance(carta, pd.DataFrame):
+        carta = montar_carta(carta, inserir_foto)
     wb = openpyxl.Workbook(); ws = wb.active; ws.title = "Sugestão"
-    row_num = 1; ordem_geral = 1
-    df_sorted = ordenar_para_saida(df)
-    for tipo in df_sorted['tipo'].fillna("").unique():
-        tipo_norm = normaliza_tipo(tipo)
+    row_num = 1
+    for secao in carta["secoes"]:
         ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=8)
-        cell = ws.cell(row=row_num, column=1, value=tipo_norm.upper()); cell.font = Font(bold=True, size=18); row_num += 1
-        for pais in df_sorted[df_sorted['tipo'] == tipo]['pais'].dropna().unique():
+        cell = ws.cell(row=row_num, column=1, value=secao["tipo"].upper()); cell.font = Font(bold=True, size=18); row_num += 1
+        for grupo in secao["paises"]:
             ws.merge_cells(start_row=row_num, start_column=1, end_row=row_num, end_column=8)
-            cell = ws.cell(row=row_num, column=1, value=str(pais).upper()); cell.font = Font(bold=True, size=14); row_num += 1
-            grupo = df_sorted[(df_sorted['tipo'] == tipo) & (df_sorted['pais'] == pais)]
-            for _, row in grupo.iterrows():
-                ws.cell(row=row_num, column=1, value=f"{ordem_geral:02d} ({int(row['cod']) if str(row['cod']).isdigit() else ''})").font = Font(size=11)
-                ws.cell(row=row_num, column=2, value=str(row['descricao'])).font = Font(bold=True, size=12)
-                if inserir_foto:
-                    imgfile = get_imagem_file(str(row.get('cod','')))
-                    if imgfile and os.path.exists(imgfile):
-                        try:
-                            img = XLImage(imgfile); img.width, img.height = 32, 24; ws.add_image(img, f"C{row_num}")
-                        except Exception: pass
-                try:
-                    base_val = float(row['preco_base']); pv_val = float(row['preco_de_venda'])
-                    base_str = f"(R$ {base_val:.2f})"; pv_str = f"R$ {pv_val:.2f}"
-                except Exception:
-                    base_str = "(R$ -)"; pv_str = "R$ -"
-                ws.cell(row=row_num, column=7, value=base_str).alignment = Alignment(horizontal='right'); ws.cell(row=row_num, column=7).font = Font(size=10)
-                ws.cell(row=row_num, column=8, value=pv_str).font = Font(bold=True, size=13); ws.cell(row=row_num, column=8).alignment = Alignment(horizontal='right')
-                uvas = [str(row.get(f"uva{i}", "")).strip() for i in range(1,4)]; uvas = [u for u in uvas if u and u.lower() != "nan"]
-                regiao_str = f"{row.get('pais','')} | {row.get('regiao','')}"
-                if uvas: regiao_str += f" | {', '.join(uvas)}"
-                ws.cell(row=row_num+1, column=2, value=regiao_str).font = Font(size=10)
-                amad = str(row.get("amadurecimento", ""))
-                if amad and amad.lower() != "nan":
+            cell = ws.cell(row=row_num, column=1, value=grupo["pais"].upper()); cell.font = Font(bold=True, size=14); row_num += 1
+            for item in grupo["itens"]:
+                ws.cell(row=row_num, column=1, value=f"{item['ordem']:02d} ({item['cod']})").font = Font(size=11)
+                ws.cell(row=row_num, column=2, value=item["descricao"]).font = Font(bold=True, size=12)
+                if inserir_foto and item["foto"]:
+                    try:
+                        img = XLImage(miniatura_imagem(item["foto"], 32, 24)); img.width, img.height = 32, 24; ws.add_image(img, f"C{row_num}")
+                    except Exception: pass
+                ws.cell(row=row_num, column=7, value=f"({item['preco_base']})").alignment = Alignment(horizontal='right'); ws.cell(row=row_num, column=7).font = Font(size=10)
+                ws.cell(row=row_num, column=8, value=item["preco_de_venda"]).font = Font(bold=True, size=13); ws.cell(row=row_num, column=8).alignment = Alignment(horizontal='right')
+                ws.cell(row=row_num+1, column=2, value=item["regiao_str"]).font = Font(size=10)
+                if item["amadurecimento"]:
                     ws.cell(row=row_num+1, column=3, value="🛢️").font = Font(size=10)
-                row_num += 2; ordem_geral += 1
+                row_num += 2
+                if progresso:
+                    progresso(item["ordem"], carta["total"], None)
         row_num += 1  # Espaço extra entre seções de tipo
     stream = io.BytesIO(); wb.save(stream); stream.seek(0); return stream
 
+def _foto_xlsx(path, largura, altura, fotos):
+    """(dados, escala_x, escala_y) da miniatura para largura x altura px; lida uma vez por exportação."""
+    if path not in fotos:
+        try:
+            with open(miniatura_imagem(path, largura, altura), "rb") as f:
+                dados = f.read()
+            with Image.open(io.BytesIO(dados)) as img:
+                w, h = img.size
+                dpi_x, dpi_y = img.info.get("dpi", (96, 96))
+            # xlsxwriter converte px em tamanho de exibição usando o DPI gravado na imagem
+            fotos[path] = (dados, largura / w * (dpi_x or 96) / 96, altura / h * (dpi_y or 96) / 96)
+        except Exception:
+            fotos[path] = None
+    return fotos[path]
+
+def exportar_excel_streaming(carta, inserir_foto=True, destino=None, progresso=None):
+    """
+    Mesmo layout de exportar_excel_like_pdf, gravado linha a linha (xlsxwriter em constant_memory),
+    com formatos compartilhados e cada foto distinta embutida uma única vez.
+    Com destino (caminho) grava direto no arquivo; sem destino devolve um BytesIO.
+    """
+    if isinstance(carta, pd.DataFrame):
+        carta = montar_carta(carta, inserir_foto)
+    saida = destino if destino is not None else io.BytesIO()
+    wb = xlsxwriter.Workbook(saida, {"constant_memory": True, "in_memory": False})
+    ws = wb.add_worksheet("Sugestão")
+    fmt_tipo = wb.add_format({"bold": True, "font_size": 18})
+    fmt_pais = wb.add_format({"bold": True, "font_size": 14})
+    fmt_ordem = wb.add_format({"font_size": 11})
+    fmt_desc = wb.add_format({"bold": True, "font_size": 12})
+    fmt_base = wb.add_format({"font_size": 10, "align": "right"})
+    fmt_venda = wb.add_format({"bold": True, "font_size": 13, "align": "right"})
+    fmt_detalhe = wb.add_format({"font_size": 10})
+    fotos = {}
+    row = 0
+    for secao in carta["secoes"]:
+        ws.merge_range(row, 0, row, 7, secao["tipo"].upper(), fmt_tipo); row += 1
+        for grupo in secao["paises"]:
+            ws.merge_range(row, 0, row, 7, grupo["pais"].upper(), fmt_pais); row += 1
+            for item in grupo["itens"]:
+                ws.write_string(row, 0, f"{item['ordem']:02d} ({item['cod']})", fmt_ordem)
+                ws.write_string(row, 1, item["descricao"], fmt_desc)
+                if inserir_foto and item["foto"]:
+                    foto = _foto_xlsx(item["foto"], 32, 24, fotos)
+                    if foto:
+                        ws.insert_image(row, 2, os.path.basename(item["foto"]), {"image_data": io.BytesIO(foto[0]), "x_scale": foto[1], "y_scale": foto[2]})
+                ws.write_string(row, 6, f"({item['preco_base']})", fmt_base)
+                ws.write_string(row, 7, item["preco_de_venda"], fmt_venda)
+                ws.write_string(row+1, 1, item["regiao_str"], fmt_detalhe)
+                if item["amadurecimento"]:
+                    ws.write_string(row+1, 2, "🛢️", fmt_detalhe)
+                row += 2
+                if progresso:
+                    progresso(item["ordem"], carta["total"], None)
+        row += 1  # Espaço extra entre seções de tipo
+    wb.close()
+    if destino is None:
+        saida.seek(0)
+    return saida
+
+def exportar_excel(carta, inserir_foto=True, destino=None, progresso=None):
+    """Exportação Excel padrão: streaming (xlsxwriter) quando instalado, senão o workbook openpyxl em memória."""
+    if xlsxwriter is not None:
+        return exportar_excel_streaming(carta, inserir_foto=inserir_foto, destino=destino, progresso=progresso)
+    stream = exportar_excel_like_pdf(carta, inserir_foto=inserir_foto, progresso=progresso)
+    if destino is None:
+        return stream
+    with open(destino, "wb") as f:
+        f.write(stream.getbuffer())
+    return destino
+
+def preview_carta(carta, cliente, inserir_foto):
+    """Texto da pré-visualização (mesmo modelo do PDF/Excel)."""
+    preview_lines = []
+    preview_lines.append("Sugestão Carta de Vinhos")
+    if cliente:
+        preview_lines.append(f"Cliente: {cliente}")
+    preview_lines.append("="*70)
+    for secao in carta["secoes"]:
+        preview_lines.append(f"\n{secao['tipo'].upper()}")
+        for grupo in secao["paises"]:
+            preview_lines.append(f"  {grupo['pais'].upper()}")
+            for item in grupo["itens"]:
+                preview_lines.append(f"    {item['ordem']:02d} ({item['cod']}) {item['descricao']}")
+                preview_lines.append(f"      {item['regiao_str']}")
+                preview_lines.append(f"      ({item['preco_base']})  {item['preco_de_venda']}")
+                if inserir_foto and item["foto"]:
+                    preview_lines.append("      [COM FOTO]")
+    preview_lines.append("\n" + "="*70)
+    now = datetime.now().strftime("%d/%m/%Y %H:%M")
+    preview_lines.append(f"Gerado em: {now}")
+    return "\n".join(preview_lines)
+
+# ===== Cache de artefatos (PDF/XLSX) =====
+ARTEFATOS_MAX_BYTES = 64 * 1024 * 1024
+ARTEFATOS_DIR = os.environ.get("CARTA_ARTEFATOS_DIR", "")  # Vazio = sem transbordo para disco
+ARTEFATOS_DISCO_MAX_BYTES = 512 * 1024 * 1024
+
+def chave_artefato(formato, selecao, preco_flag, fator_global, manual_fat, manual_preco_venda,
+                   cliente, logo_bytes, inserir_foto, versao_catalogo=None, cadastrados=()):
+    """Hash de tudo que define o arquivo gerado: itens, tabela, fator, ajustes, cliente, logo, fotos e catálogo."""
+    h = hashlib.sha1()
+    h.update(json.dumps([formato, preco_flag, float(fator_global), cliente or "", bool(inserir_foto),
+                         list(versao_catalogo) if versao_catalogo else None,
+                         sorted((int(k), float(v)) for k, v in manual_fat.items()),
+                         sorted((int(k), float(v)) for k, v in manual_preco_venda.items()),
+                         list(cadastrados)], default=str).encode())
+    h.update(selecao.indices().tobytes())
+    h.update(hashlib.sha1(logo_bytes or b"").digest())
+    if inserir_foto:
+        # Foto trocada/adicionada muda o mtime da pasta e invalida o artefato
+        ind = indice_imagens()
+        h.update(repr([ind["raizes"].get(r, {}).get("mtime") for r in IMAGEM_DIRS]).encode())
+    return h.hexdigest()
+
+class CacheArtefatos:
+    """
+    LRU de arquivos gerados (bytes) limitado pelo total em memória. Com pasta, o que sai da memória
+    é gravado em disco (também limitado; removem-se os menos usados) e volta para a memória ao ser pedido.
+    Artefatos renderizados direto em arquivo (guardar_arquivo) ficam só no disco, na pasta ou no temporário.
+    """
+    def __init__(self, max_bytes=ARTEFATOS_MAX_BYTES, pasta="", max_bytes_disco=ARTEFATOS_DISCO_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.pasta = pasta
+        self.pasta_arquivos = pasta or os.path.join(tempfile.gettempdir(), "carta_artefatos")
+        self.max_bytes_disco = max_bytes_disco
+        self.itens = OrderedDict()
+        self.bytes = 0
+        self.bytes_disco = None
+        self.lock = threading.Lock()
+
+    def obter(self, chave, promover=True):
+        """
+        Bytes do artefato (memória ou disco) ou None. promover=False lê do disco sem trazer para o LRU
+        (download de artefatos grandes: a memória continua estável e localizar segue devolvendo o caminho).
+        """
+        with self.lock:
+            dados = self.itens.get(chave)
+            if dados is not None:
+                self.itens.move_to_end(chave)
+                return dados
+        path = os.path.join(self.pasta_arquivos, chave)
+        try:
+            with open(path, "rb") as f:
+                dados = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        if promover:
+            self.guardar(chave, dados, gravar_disco=False)
+        return dados
+
+    def localizar(self, chave):
+        """Bytes se estiver em memória, senão o caminho em disco (sem ler o arquivo), ou None."""
+        with self.lock:
+            dados = self.itens.get(chave)
+            if dados is not None:
+                self.itens.move_to_end(chave)
+                return dados
+        path = os.path.join(self.pasta_arquivos, chave)
+        return path if os.path.exists(path) else None
+
+    def novo_arquivo(self, sufixo=""):
+        """Caminho temporário na pasta do cache para renderizar direto em disco (depois: guardar_arquivo)."""
+        os.makedirs(self.pasta_arquivos, exist_ok=True)
+        return os.path.join(self.pasta_arquivos, f"{os.urandom(8).hex()}{sufixo}.tmp")
+
+    def guardar_arquivo(self, chave, path):
+        """Registra um artefato já gravado em disco (de novo_arquivo) sem trazê-lo para a memória."""
+        destino = os.path.join(self.pasta_arquivos, chave)
+        os.replace(path, destino)
+        self._contabilizar_disco(os.path.getsize(destino))
+        return destino
+
+    def guardar(self, chave, dados, gravar_disco=True):
+        dados = bytes(dados)
+        despejados = []
+        with self.lock:
+            anterior = self.itens.pop(chave, None)
+            if anterior is not None:
+                self.bytes -= len(anterior)
+            if len(dados) <= self.max_bytes:
+                self.itens[chave] = dados
+                self.bytes += len(dados)
+            elif gravar_disco:
+                despejados.append((chave, dados))
+            while self.bytes > self.max_bytes:
+                k, v = self.itens.popitem(last=False)
+                self.bytes -= len(v)
+                despejados.append((k, v))
+        if self.pasta:
+            for k, v in despejados:
+                self._gravar_disco(k, v)
+        return dados
+
+    def _gravar_disco(self, chave, dados):
+        path = os.path.join(self.pasta_arquivos, chave)
+        if os.path.exists(path):
+            return
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.pasta, exist_ok=True)
+            with open(tmp, "wb") as f:
+                f.write(dados)
+            os.replace(tmp, path)
+        except OSError:
+            return
+        self._contabilizar_disco(len(dados))
+
+    def _contabilizar_disco(self, tamanho):
+        with self.lock:
+            if self.bytes_disco is None:
+                self._podar_disco()
+            else:
+                self.bytes_disco += tamanho
+                if self.bytes_disco > self.max_bytes_disco:
+                    self._podar_disco()
+
+    def _podar_disco(self):
+        """Mesma política das miniaturas: remove os de mtime mais antigo até 80% do limite."""
+        entradas = []
+        try:
+            with os.scandir(self.pasta_arquivos) as it:
+                for e in it:
+                    if e.is_file() and not e.name.endswith(".tmp"):
+                        info = e.stat()
+                        entradas.append((info.st_mtime, info.st_size, e.path))
+        except OSError:
+            return
+        total = sum(e[1] for e in entradas)
+        if total > self.max_bytes_disco:
+            for _, tamanho, path in sorted(entradas):
+                try:
+                    os.remove(path)
+                    total -= tamanho
+                except OSError:
+                    pass
+                if total <= self.max_bytes_disco * 0.8:
+                    break
+        self.bytes_disco = total
+
+def cache_artefatos():
+    """Cache de artefatos do processo (compartilhado pelas sessões: a chave já inclui cliente, logo e itens)."""
+    reg = _registro_processo()
+    with reg["lock"]:
+        if "artefatos" not in reg:
+            reg["artefatos"] = CacheArtefatos(pasta=ARTEFATOS_DIR)
+        return reg["artefatos"]
+
+# ===== Fila de exportação em segundo plano =====
+EXPORTACAO_WORKERS = int(os.environ.get("CARTA_EXPORTACAO_WORKERS", "2") or 2)
+# A partir de quantos itens a carta é renderizada direto em arquivo (memória estável; download lido do disco)
+EXPORTACAO_ARQUIVO_MIN_ITENS = int(os.environ.get("CARTA_EXPORTACAO_ARQUIVO_MIN_ITENS", "1000") or 1000)
+
+class ExportacaoCancelada(Exception):
+    pass
+
+class TrabalhoExportacao:
+    """
+    Handle de uma exportação: estado, progresso (itens/páginas), cancelamento e o artefato pronto.
+    Compartilhado pelas sessões que pediram o mesmo artefato (inscritos); só é cancelado quando a última sai.
+    """
+    def __init__(self, formato, chave, total):
+        self.id = os.urandom(6).hex()
+        self.formato, self.chave, self.total = formato, chave, total
+        self.estado = "na fila"  # na fila -> gerando -> concluído | cancelado | erro
+        self.feitos = 0
+        self.paginas = None
+        self.erro = None
+        self.dados = None
+        self.inicio = time.time()
+        self.espera = None  # Segundos na fila antes de começar a renderizar
+        self.duracao = None
+        self.inscritos = set()
+        self._cancelar = threading.Event()
+
+    @property
+    def terminado(self):
+        return self.estado in ("concluído", "cancelado", "erro")
+
+    def cancelar(self):
+        self._cancelar.set()
+
+    def progresso(self, feitos, total, paginas=None):
+        """Passado como progresso= ao gerar_pdf/exportar_excel; é aqui que o cancelamento interrompe a geração."""
+        if self._cancelar.is_set():
+            raise ExportacaoCancelada()
+        self.feitos, self.total, self.paginas = feitos, total, paginas
+
+    def span(self):
+        """Registro no formato da instrumentação: a renderização roda fora do rerun e entra no painel do seguinte."""
+        dados = self.dados
+        tamanho = os.path.getsize(dados) if isinstance(dados, str) and os.path.exists(dados) else len(dados or b"")
+        espera = self.espera or 0.0
+        return {"span": f"{self.formato}.render", "nivel": 0, "ms": round(((self.duracao or 0.0) - espera) * 1000, 2),
+                "linhas": self.total, "paginas": self.paginas, "bytes": tamanho, "fila_ms": round(espera * 1000, 2),
+                "disco": isinstance(dados, str)}
+
+    def descricao(self):
+        texto = f"{self.feitos} de {self.total} itens"
+        if self.paginas:
+            texto += f", {self.paginas} página(s)"
+        return texto
+
+class FilaExportacao:
+    """Pool de threads para PDF/Excel; o resultado vai para o cache de artefatos. Pedidos iguais em andamento são unificados."""
+    def __init__(self, workers=EXPORTACAO_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="exportacao")
+        self.em_andamento = {}
+        self.lock = threading.Lock()
+
+    def enviar(self, formato, chave, total, renderizar, sessao=None):
+        """
+        renderizar(progresso) devolve BytesIO/bytes ou o caminho do arquivo gravado (de cache_artefatos().novo_arquivo).
+        Devolve o TrabalhoExportacao (já concluído se estava no cache), com a sessão inscrita nele.
+        """
+        with self.lock:
+            trabalho = self.em_andamento.get(chave)
+            if trabalho is not None and not trabalho._cancelar.is_set():
+                trabalho.inscritos.add(sessao)
+                return trabalho
+            trabalho = TrabalhoExportacao(formato, chave, total)
+            trabalho.inscritos.add(sessao)
+            dados = cache_artefatos().localizar(chave)
+            if dados is not None:
+                trabalho.dados, trabalho.feitos, trabalho.estado, trabalho.duracao = dados, total, "concluído", 0.0
+                return trabalho
+            self.em_andamento[chave] = trabalho
+        self.pool.submit(self._executar, trabalho, renderizar)
+        return trabalho
+
+    def sair(self, trabalho, sessao=None):
+        """A sessão deixa de esperar pelo trabalho; ele só é cancelado se nenhuma outra sessão continua inscrita."""
+        with self.lock:
+            trabalho.inscritos.discard(sessao)
+            if not trabalho.inscritos:
+                trabalho.cancelar()
+
+    def _executar(self, trabalho, renderizar):
+        try:
+            trabalho.progresso(0, trabalho.total)
+            trabalho.espera = time.time() - trabalho.inicio
+            trabalho.estado = "gerando"
+            gerado = renderizar(trabalho.progresso)
+            if isinstance(gerado, str):
+                trabalho.dados = cache_artefatos().guardar_arquivo(trabalho.chave, gerado)
+            else:
+                trabalho.dados = cache_artefatos().guardar(trabalho.chave, gerado.getvalue() if hasattr(gerado, "getvalue") else gerado)
+            trabalho.estado = "concluído"
+        except ExportacaoCancelada:
+            trabalho.estado = "cancelado"
+        except Exception as e:
+            trabalho.erro = str(e)
+            trabalho.estado = "erro"
+        finally:
+            trabalho.duracao = time.time() - trabalho.inicio
+            with self.lock:
+                if self.em_andamento.get(trabalho.chave) is trabalho:
+                    del self.em_andamento[trabalho.chave]
+
+def fila_exportacao():
+    reg = _registro_processo()
+    with reg["lock"]:
+        if "fila_exportacao" not in reg:
+            reg["fila_exportacao"] = FilaExportacao()
+        return reg["fila_exportacao"]
+
+@st.fragment(run_every=1.0)
+def painel_exportacoes():
+    """Progresso das exportações da sessão, atualizado a cada segundo sem rerodar o app inteiro."""
+    trabalhos = st.session_state.get("exportacoes", {})
+    for formato, trabalho in list(trabalhos.items()):
+        rotulo = "PDF" if formato == "pdf" else "Excel"
+        if trabalho.terminado:
+            del trabalhos[formato]
+            if trabalho.estado == "concluído":
+                st.session_state.setdefault("artefatos_sessao", {})[formato] = trabalho.chave
+                if DESEMPENHO_LOG or st.session_state.get("desempenho_ativo", False):
+                    # Herdado pelo iniciar_instrumentacao do rerun abaixo, como os spans dos callbacks
+                    st.session_state.setdefault("desempenho_callbacks", []).append(trabalho.span())
+            else:
+                aviso = f"{rotulo} cancelado." if trabalho.estado == "cancelado" else f"Erro ao gerar {rotulo}: {trabalho.erro}"
+                st.session_state.setdefault("avisos_exportacao", []).append(aviso)
+            st.rerun()
+        col1, col2 = st.columns([5, 1])
+        with col1:
+            fracao = trabalho.feitos / trabalho.total if trabalho.total else 0.0
+            st.progress(min(fracao, 1.0), text=f"{rotulo} {trabalho.estado}: {trabalho.descricao()}")
+        with col2:
+            if st.button("Cancelar", key=f"cancelar_{trabalho.id}"):
+                # Outras sessões esperando o mesmo artefato continuam recebendo; esta só deixa de acompanhar
+                fila_exportacao().sair(trabalho, st.session_state.get("sessao_id"))
+                del trabalhos[formato]
+                st.session_state.setdefault("avisos_exportacao", []).append(f"{rotulo} cancelado.")
+                st.rerun()
+
+# ===== Instrumentação (painel Desempenho) =====
+DESEMPENHO_MAX_RERUNS = 50
+DESEMPENHO_MEMORIA_TTL = 600  # Segundos sem rerun até a sessão deixar de contar como usuária do tracemalloc
+DESEMPENHO_LOG = os.environ.get("CARTA_DESEMPENHO_LOG", "")  # Se definido: mede todas as sessões e anexa o JSON lines aqui
+
+class _SpanNulo:
+    """Span da instrumentação desligada: entrar, sair e anotar não fazem nada."""
+    def __enter__(self):
+        return self
+    def __exit__(self, *exc):
+        return False
+    def anotar(self, **dados):
+        pass
+
+_SPAN_NULO = _SpanNulo()
+
+class _Span:
+    __slots__ = ("inst", "registro", "inicio", "base", "pico")
+
+    def __init__(self, inst, nome, dados):
+        self.inst = inst
+        self.registro = {"span": nome, "nivel": 0, "ms": None, **dados}
+
+    def anotar(self, **dados):
+        self.registro.update(dados)
+
+    def __enter__(self):
+        # Registrado na entrada, para a lista ficar na ordem de início (pai antes dos internos)
+        self.registro["nivel"] = len(self.inst.pilha)
+        self.inst.spans.append(self.registro)
+        self.inst.pilha.append(self)
+        if self.inst.memoria:
+            self.base = tracemalloc.get_traced_memory()[0]
+            self.pico = self.base
+            tracemalloc.reset_peak()
+        self.inicio = time.perf_counter()
+        return self
+
+    def __exit__(self, tipo, exc, tb):
+        duracao = time.perf_counter() - self.inicio
+        self.inst.pilha.pop()
+        registro = self.registro
+        registro["ms"] = round(duracao * 1000, 2)
+        if self.inst.memoria:
+            # reset_peak dos spans internos zera o pico deste; eles devolvem o seu ao sair
+            pico = max(self.pico, tracemalloc.get_traced_memory()[1])
+            registro["pico_mb"] = round((pico - self.base) / 1024 / 1024, 2)
+            if self.inst.pilha:
+                self.inst.pilha[-1].pico = max(self.inst.pilha[-1].pico, pico)
+        if tipo is not None:
+            registro["erro"] = tipo.__name__
+        return False
+
+class Instrumentacao:
+    """
+    Spans nomeados de um rerun (duração, linhas processadas, bytes gerados e, opcionalmente, pico de memória
+    via tracemalloc). Desligada, span() devolve sempre o mesmo objeto vazio.
+    """
+    def __init__(self, ativa=False, memoria=False, spans=None):
+        self.ativa = ativa
+        self.memoria = ativa and memoria
+        self.spans = list(spans or [])
+        self.pilha = []
+        self.inicio = time.perf_counter()
+        self.data = datetime.now().isoformat(timespec="seconds")
+        if self.memoria and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def span(self, nome, **dados):
+        if not self.ativa:
+            return _SPAN_NULO
+        return _Span(self, nome, dados)
+
+    def finalizar(self):
+        """Registro do rerun: spans na ordem de início, mais o total."""
+        return {"data": self.data, "total_ms": round((time.perf_counter() - self.inicio) * 1000, 2), "spans": self.spans}
+
+def desempenho_jsonl(reruns, sessao=""):
+    """Uma linha JSON por span (mais uma linha "rerun" com o total), pronta para jq/pandas.read_json(lines=True)."""
+    linhas = []
+    for n, rerun in reruns:
+        base = {"sessao": sessao, "rerun": n, "data": rerun["data"]}
+        linhas.append(json.dumps({**base, "span": "rerun", "nivel": -1, "ms": rerun["total_ms"]}, ensure_ascii=False))
+        linhas.extend(json.dumps({**base, **span}, ensure_ascii=False, default=str) for span in rerun["spans"])
+    return "\n".join(linhas) + ("\n" if linhas else "")
+
+def iniciar_instrumentacao():
+    """Instrumentação do rerun atual; herda os spans medidos nos callbacks que rodaram antes do script."""
+    ativa = bool(DESEMPENHO_LOG) or st.session_state.get("desempenho_ativo", False)
+    return Instrumentacao(ativa, st.session_state.get("desempenho_memoria", False),
+                          spans=st.session_state.pop("desempenho_callbacks", None))
+
+def _uso_tracemalloc(sessao, ativo):
+    """
+    tracemalloc vale para o processo inteiro: guarda quais sessões pediram o pico de memória (com o horário do
+    último rerun) e só para o rastreamento quando nenhuma sessão recente continua usando.
+    """
+    reg = _registro_processo()
+    with reg["lock"]:
+        usuarios = reg.setdefault("tracemalloc_sessoes", {})
+        agora = time.monotonic()
+        if ativo:
+            usuarios[sessao] = agora
+        else:
+            usuarios.pop(sessao, None)
+        for s, visto in list(usuarios.items()):
+            if agora - visto > DESEMPENHO_MEMORIA_TTL:  # Sessão fechada sem desmarcar a opção
+                del usuarios[s]
+        if not usuarios and not DESEMPENHO_LOG and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+def painel_desempenho(inst):
+    """Fecha o rerun, guarda no histórico da sessão (e no log, se configurado) e desenha o painel na barra lateral."""
+    sessao = st.session_state.setdefault("desempenho_sessao", os.urandom(4).hex())
+    historico = st.session_state.setdefault("desempenho", [])
+    if inst.ativa:
+        n = historico[-1][0] + 1 if historico else 1
+        historico.append((n, inst.finalizar()))
+        del historico[:-DESEMPENHO_MAX_RERUNS]
+        if DESEMPENHO_LOG:
+            try:
+                with _registro_processo()["lock"], open(DESEMPENHO_LOG, "a", encoding="utf-8") as f:
+                    f.write(desempenho_jsonl(historico[-1:], sessao))
+            except OSError:
+                pass
+
+    with st.sidebar.expander("Desempenho", expanded=False):
+        st.checkbox("Medir desempenho", value=bool(DESEMPENHO_LOG), key="desempenho_ativo",
+                    disabled=bool(DESEMPENHO_LOG), help="Tempo por etapa de cada rerun desta sessão")
+        memoria = st.checkbox("Incluir pico de memória", value=False, key="desempenho_memoria",
+                              help="Usa tracemalloc: deixa o app mais lento e mede o processo inteiro")
+        _uso_tracemalloc(sessao, memoria)
+        if not historico:
+            st.caption("Nenhum rerun medido ainda.")
+            return
+        n, ultimo = historico[-1]
+        st.caption(f"Rerun {n}: {ultimo['total_ms']:.0f} ms")
+        tabela = pd.DataFrame(ultimo["spans"])
+        if not tabela.empty:
+            tabela["span"] = ["  " * int(v) + s for s, v in zip(tabela["span"], tabela["nivel"])]
+            st.dataframe(tabela.drop(columns=["nivel"]), hide_index=True, use_container_width=True)
+        lentos = sorted(historico, key=lambda r: r[1]["total_ms"], reverse=True)[:5]
+        st.caption("Reruns mais lentos: " + ", ".join(f"#{i} {r['total_ms']:.0f} ms" for i, r in lentos))
+        st.download_button("Exportar (JSON lines)", data=desempenho_jsonl(historico, sessao),
+                           file_name=f"desempenho_{sessao}.jsonl", mime="application/x-ndjson", key="dl_desempenho")
+        if st.button("Limpar histórico", key="btn_limpar_desempenho"):
+            historico.clear()
+
 # ===================== APP =====================
 def main():
     st.set_page_config(page_title="Sugestão de Carta de Vinhos", layout="wide")
+    inst = iniciar_instrumentacao()
     garantir_pastas()
 
     # Inicializar estado
+    if "sessao_id" not in st.session_state:
+        st.session_state.sessao_id = os.urandom(6).hex()  # Inscrição nas exportações compartilhadas
     if "selected_idxs" not in st.session_state:
-        st.session_state.selected_idxs = set()
+        st.session_state.selected_idxs = SelecaoBitmap()
     if "manual_fat" not in st.session_state:
         st.session_state.manual_fat = {}
     if "manual_preco_venda" not in st.session_state:
         st.session_state.manual_preco_venda = {}
-    if "cadastrados" not in st.session_state:
-        st.session_state.cadastrados = []
     if "reset_filters" not in st.session_state:
         st.session_state.reset_filters = False
     if "last_suggestion" not in st.session_state:
@@ -363,9 +2198,7 @@ def main():
         with c2:
             inserir_foto = st.checkbox("Inserir foto no PDF/Excel", value=True, key="chk_foto")
         with c3:
-            preco_flag = st.selectbox("Tabela de preço",
-                                      ["preco1", "preco2", "preco15", "preco38", "preco39", "preco55", "preco63"],
-                                      index=0, key="preco_flag")
+            preco_flag = st.selectbox("Tabela de preço", TABELAS_PRECO, index=0, key="preco_flag")
         with c4:
             termo_global = st.text_input("Buscar", value="" if st.session_state.reset_filters else st.session_state.get("termo_global", ""), key="termo_global")
         with c5:
@@ -380,35 +2213,64 @@ def main():
         logo_cliente = st.file_uploader("Carregar logo (cliente)", type=["png","jpg","jpeg"], key="logo_cliente")
         logo_bytes = logo_cliente.read() if logo_cliente else None
 
-    # Carrega DF base
-    df = ler_excel_vinhos(caminho_planilha)
+    # Carrega DF base (cacheado por versão do arquivo; copiado porque é compartilhado entre sessões)
+    with inst.span("catalogo") as span:
+        df = carregar_catalogo(caminho_planilha)
+        if df is not None:
+            catalogo = df
+            versao_catalogo = catalogo.attrs.get("chave_catalogo")
+            # Todas as tabelas convertidas uma vez por versão do catálogo; trocar de tabela só escolhe a coluna
+            matriz_precos = derivado_do_catalogo("precos", versao_catalogo, lambda: construir_matriz_precos(catalogo_base(catalogo)))
+            # idx -> linha de todo o catálogo (planilha + diário): seleções, ajustes e sugestões sem varrer o df
+            produtos = derivado_do_catalogo("produtos", versao_catalogo + (catalogo.attrs.get("versao_cadastros"),)
+                                            if versao_catalogo else None, lambda: IndiceProdutos(catalogo))
+            # Sem cópia: as colunas do catálogo são compartilhadas, só as de preço são da sessão
+            df = aplicar_tabela(df.copy(deep=False), matriz_precos, preco_flag, fator_global)
+            span.anotar(linhas=len(df))
     if df is None:
         st.warning("Corrija o problema com o arquivo de dados e tente novamente.")
+        painel_desempenho(inst)
         return
-    df = atualiza_coluna_preco_base(df, preco_flag, fator_global=float(fator_global))
-
-    # Integra itens cadastrados (sessão)
-    if st.session_state.cadastrados:
-        cad_df = pd.DataFrame(st.session_state.cadastrados)
-        for col in df.columns:
-            if col not in cad_df.columns:
-                cad_df[col] = None
-        cad_df["idx"] = pd.to_numeric(cad_df["idx"], errors="coerce").fillna(-1).astype(int)
-        df = pd.concat([df, cad_df[df.columns]], ignore_index=True)
-
-    # Sidebar de filtros
+    delta = catalogo.attrs.get("delta")
+    if delta and st.session_state.get("delta_visto") != versao_catalogo:
+        st.session_state.delta_visto = versao_catalogo
+        exemplos = "; ".join(f"{k}: {', '.join(v)}" for k, v in delta["exemplos"].items() if v)
+        st.info(f"Catálogo atualizado: {delta['adicionados']} novos, {delta['removidos']} removidos, "
+                f"{delta['alterados']} alterados ({delta['so_preco']} só preço)." + (f" Ex.: {exemplos}" if exemplos else ""))
+
+    # Sidebar de filtros (opções do índice de facetas, com a contagem de cada opção no filtro atual)
     st.sidebar.header("Filtros")
-    pais_opc = [""] + sorted([p for p in df["pais"].dropna().astype(str).unique().tolist() if p])
-    tipo_opc = [""] + sorted([t for t in df["tipo"].dropna().astype(str).unique().tolist() if t])
-    desc_opc = [""] + sorted([d for d in df["descricao"].dropna().astype(str).unique().tolist() if d])
-    regiao_opc = [""] + sorted([r for r in df["regiao"].dropna().astype(str).unique().tolist() if r])
-    cod_opc = [""] + sorted([str(c) for c in df["cod"].dropna().astype(str).unique().tolist()])
-
-    filt_pais = st.sidebar.selectbox("País", pais_opc, index=0 if st.session_state.reset_filters else pais_opc.index(st.session_state.get("filt_pais", "")) if st.session_state.get("filt_pais", "") in pais_opc else 0, key="filt_pais")
-    filt_tipo = st.sidebar.selectbox("Tipo", tipo_opc, index=0 if st.session_state.reset_filters else tipo_opc.index(st.session_state.get("filt_tipo", "")) if st.session_state.get("filt_tipo", "") in tipo_opc else 0, key="filt_tipo")
-    filt_desc = st.sidebar.selectbox("Descrição", desc_opc, index=0 if st.session_state.reset_filters else desc_opc.index(st.session_state.get("filt_desc", "")) if st.session_state.get("filt_desc", "") in desc_opc else 0, key="filt_desc")
-    filt_regiao = st.sidebar.selectbox("Região", regiao_opc, index=0 if st.session_state.reset_filters else regiao_opc.index(st.session_state.get("filt_regiao", "")) if st.session_state.get("filt_regiao", "") in regiao_opc else 0, key="filt_regiao")
-    filt_cod = st.sidebar.selectbox("Código", cod_opc, index=0 if st.session_state.reset_filters else cod_opc.index(st.session_state.get("filt_cod", "")) if st.session_state.get("filt_cod", "") in cod_opc else 0, key="filt_cod")
+    reset = st.session_state.reset_filters
+
+    def mascara_nao_facetada(preco_min, preco_max):
+        m = np.ones(len(df), dtype=bool)
+        if termo_global.strip():
+            indice_busca = derivado_do_catalogo("busca", versao_catalogo, lambda: construir_indice_busca(catalogo_base(catalogo)))
+            m &= mascara_busca(df, termo_global, indice_busca)
+        preco = df["preco_base"].fillna(0).to_numpy(dtype=float)
+        if preco_min:
+            m &= preco >= float(preco_min)
+        if preco_max and preco_max > 0:
+            m &= preco <= float(preco_max)
+        return m
+
+    # Os widgets ainda não foram desenhados neste rerun: contagens a partir dos valores atuais do session_state
+    selecoes = {col: "" if reset else st.session_state.get(key, "") for col, _, key in FACETAS_SIDEBAR}
+    precos = (0.0, 0.0) if reset else (st.session_state.get("preco_min", 0.0), st.session_state.get("preco_max", 0.0))
+    with inst.span("filtros.facetas", linhas=len(df)):
+        indice_facetas = derivado_do_catalogo("facetas", versao_catalogo, lambda: construir_facetas(catalogo_base(catalogo)))
+        mask, contagens, opcoes_facetas = filtrar_facetas(indice_facetas, df, selecoes, mascara_nao_facetada(*precos))
+
+    valores_filtro = {}
+    for col, rotulo, key in FACETAS_SIDEBAR:
+        mapa, opcoes = opcoes_facetas[col]
+        cont = contagens[col]
+        opcoes = [""] + opcoes
+        atual = selecoes[col]
+        valores_filtro[col] = st.sidebar.selectbox(
+            rotulo, opcoes, index=opcoes.index(atual) if atual in opcoes else 0, key=key,
+            format_func=lambda v, mapa=mapa, cont=cont: f"{v} ({cont[mapa[v]]})" if v else "",
+        )
 
     colp1, colp2 = st.sidebar.columns(2)
     with colp1:
@@ -419,56 +2281,27 @@ def main():
     # Resetar filtros
     if resetar:
         st.session_state.reset_filters = True
-        st.session_state.selected_idxs = set()
+        st.session_state.selected_idxs = SelecaoBitmap()
         st.session_state.last_suggestion = ""
         st.rerun()
 
     if st.session_state.reset_filters:
         st.session_state.reset_filters = False
 
-    # Aplicar filtros
-    df_filtrado = df.copy()
-    if termo_global.strip():
-        term = termo_global.strip().lower()
-        mask = df_filtrado.apply(lambda row: term in " ".join(str(v).lower() for v in row.values), axis=1)
-        df_filtrado = df_filtrado[mask]
-    if filt_pais:
-        df_filtrado = df_filtrado[df_filtrado["pais"] == filt_pais]
-    if filt_tipo:
-        df_filtrado = df_filtrado[df_filtrado["tipo"] == filt_tipo]
-    if filt_desc:
-        df_filtrado = df_filtrado[df_filtrado["descricao"] == filt_desc]
-    if filt_regiao:
-        df_filtrado = df_filtrado[df_filtrado["regiao"] == filt_regiao]
-    if filt_cod:
-        df_filtrado = df_filtrado[df_filtrado["cod"].astype(str) == filt_cod]
-    if preco_min:
-        df_filtrado = df_filtrado[df_filtrado["preco_base"].fillna(0) >= float(preco_min)]
-    if preco_max and preco_max > 0:
-        df_filtrado = df_filtrado[df_filtrado["preco_base"].fillna(0) <= float(preco_max)]
+    # Aplicar filtros (uma única máscara; só refaz se os widgets devolveram valores diferentes dos previstos)
+    with inst.span("filtros.aplicar", linhas=len(df)) as span:
+        if valores_filtro != selecoes or (preco_min, preco_max) != precos:
+            mask, _, _ = filtrar_facetas(indice_facetas, df, valores_filtro, mascara_nao_facetada(preco_min, preco_max))
+        linhas_filtradas = np.flatnonzero(mask)  # Posições em df: a grade lê só a página, sem copiar o filtrado
+        span.anotar(resultado=len(linhas_filtradas))
 
     # Validar seleções
-    valid_selected_idxs = st.session_state.selected_idxs & set(df["idx"])
-    if valid_selected_idxs != st.session_state.selected_idxs:
-        st.session_state.selected_idxs = valid_selected_idxs
+    selecao = st.session_state.selected_idxs
+    selecao.desmarcar(produtos.ausentes(selecao.indices()))
 
     # Contagem por tipo
-    contagem = {
-        'Espumantes': 0, 'Frisantes': 0, 'Vinhos Brancos': 0, 'Vinhos Rosés': 0,
-        'Vinhos Tintos': 0, 'Fortificados': 0, 'Vinhos Sobremesas': 0, 'Licorosos': 0, 'outros': 0
-    }
-    for t, n in df_filtrado.groupby('tipo').size().items():
-        t_low = str(t).lower()
-        if "espum" in t_low: contagem['Espumantes'] += int(n)
-        elif "fris" in t_low: contagem['Frisantes'] += int(n)
-        elif "branc" in t_low: contagem['Vinhos Brancos'] += int(n)
-        elif "ros" in t_low: contagem['Vinhos Rosés'] += int(n)
-        elif "tint" in t_low: contagem['Vinhos Tintos'] += int(n)
-        elif "forti" in t_low: contagem['Fortificados'] += int(n)
-        elif "sobrem" in t_low: contagem['Vinhos Sobremesas'] += int(n)
-        elif "licor" in t_low: contagem['Licorosos'] += int(n)
-        else: contagem['outros'] += int(n)
-    total = len(df_filtrado)
+    contagem = contagem_tipos(_secoes_tipo(df)[0].iloc[linhas_filtradas])
+    total = len(linhas_filtradas)
     selecionados = len(st.session_state.selected_idxs)
     st.caption(f"Espumantes: {contagem.get('Espumantes', 0)} | Frisantes: {contagem.get('Frisantes', 0)} | "
                f"Brancos: {contagem.get('Vinhos Brancos', 0)} | Rosés: {contagem.get('Vinhos Rosés', 0)} | "
@@ -478,7 +2311,6 @@ def main():
 
     # === Grade com seleção ===
     def preparar_view_df(df_filtrado, selected_idxs):
-        start_time = time.time()
         view_df = df_filtrado.copy()
         if not isinstance(view_df, pd.DataFrame):
             view_df = pd.DataFrame(view_df)
@@ -507,36 +2339,64 @@ def main():
                 view_df[_c] = to_float_series(_col, default=0.0)
             else:
                 view_df[_c] = 0.0
-        view_df["selecionado"] = view_df["idx"].isin(selected_idxs)
-        # Debug: Tempo de preparação da grade
-        # st.write(f"Tempo de preparação da grade: {time.time() - start_time:.2f} segundos")
+        for _c in ["descricao", "pais"]:
+            if isinstance(view_df[_c].dtype, pd.CategoricalDtype):
+                view_df[_c] = view_df[_c].astype(object)  # Texto livre na grade, não selectbox de categorias
+        view_df["selecionado"] = selected_idxs.mascara(view_df["idx"].to_numpy())
         return view_df[["selecionado", "cod", "descricao", "pais", "preco_base", "preco_de_venda", "idx"]]
 
-    def update_selections():
-        start_time = time.time()
+    def update_selections(chave=None):
         current_time = time.time()
         if current_time - st.session_state.last_update_time < 0.5:  # Debounce de 0.5s
             return
         st.session_state.last_update_time = current_time
+        # O callback roda antes do script: os spans ficam guardados para o próximo iniciar_instrumentacao
+        cb = Instrumentacao(bool(DESEMPENHO_LOG) or st.session_state.get("desempenho_ativo", False))
         try:
-            edited = st.session_state.get("editor_main")
-            if isinstance(edited, dict) and "data" in edited:
-                edited = pd.DataFrame(edited["data"])
-            if isinstance(edited, pd.DataFrame) and not edited.empty:
-                previous_selected = st.session_state.selected_idxs.copy()
-                current_view_idxs = set(edited["idx"].astype(int))
-                current_selected = set(edited[edited["selecionado"] == True]["idx"].astype(int))
-                to_remove = previous_selected & current_view_idxs - current_selected
-                new_selected_idxs = (previous_selected - to_remove) | current_selected
-                if new_selected_idxs != st.session_state.selected_idxs:
-                    st.session_state.selected_idxs = new_selected_idxs
-                    # Debug: Verificar seleções após callback
-                    # st.write(f"Seleções após callback: {st.session_state.selected_idxs}")
-                    # st.write(f"Tempo de update_selections: {time.time() - start_time:.2f} segundos")
+            with cb.span("callback.selecao") as span:
+                # Só as linhas editadas (posição na grade -> idx guardado no último render)
+                chave_grade, grade_idx = st.session_state.get("grade_idx", (None, None))
+                edicoes = (st.session_state.get(chave or chave_grade) or {}).get("edited_rows", {})
+                if edicoes and grade_idx is not None and (chave or chave_grade) == chave_grade:
+                    itens = [(int(p), bool(mud["selecionado"])) for p, mud in edicoes.items()
+                             if "selecionado" in mud and int(p) < len(grade_idx)]
+                    span.anotar(linhas=len(itens))
+                    if itens:
+                        pos, marcados = zip(*itens)
+                        st.session_state.selected_idxs.aplicar_edicao(grade_idx[list(pos)], marcados)
+                        # Debug: Verificar seleções após callback
+                        # st.write(f"Seleções após callback: {len(st.session_state.selected_idxs)}")
         except Exception as e:
             st.error(f"Erro no callback de atualização: {e}")
-
-    view_df = preparar_view_df(df_filtrado, st.session_state.selected_idxs)
+        if cb.spans:
+            st.session_state.setdefault("desempenho_callbacks", []).extend(cb.spans)
+
+    # Janela da grade: só a página atual é copiada e enviada ao navegador
+    g1, g2, g3, g4, g5 = st.columns([1, 1.4, 0.8, 1, 2])
+    with g1:
+        tamanho_pagina = st.selectbox("Itens por página", GRADE_TAMANHOS, index=1, key="grade_tamanho")
+    with g2:
+        ordenar_por = st.selectbox("Ordenar por", list(GRADE_ORDENACOES), key="grade_ordem")
+    with g3:
+        decrescente = st.checkbox("Decrescente", value=False, key="grade_desc")
+    total_paginas = max(1, -(-len(linhas_filtradas) // tamanho_pagina))
+    if st.session_state.get("grade_pagina", 1) > total_paginas:
+        st.session_state.grade_pagina = total_paginas
+    with g4:
+        pagina = st.number_input("Página", min_value=1, max_value=total_paginas, step=1, key="grade_pagina")
+    with inst.span("grade.janela", linhas=len(linhas_filtradas)):
+        janela, total_paginas = janela_grade(df, GRADE_ORDENACOES[ordenar_por], decrescente, pagina, tamanho_pagina,
+                                             st.session_state.selected_idxs, linhas=linhas_filtradas)
+    with g5:
+        inicio_jan = (int(pagina) - 1) * tamanho_pagina
+        st.caption(f"Mostrando {inicio_jan + 1 if len(janela) else 0}–{inicio_jan + len(janela)} de {len(linhas_filtradas)} "
+                   f"(página {int(pagina)} de {total_paginas})")
+
+    with inst.span("grade.preparar", linhas=len(janela)):
+        view_df = preparar_view_df(janela, st.session_state.selected_idxs)
+    # A chave do editor muda junto com as linhas exibidas, para as edições nunca caírem em outra página
+    chave_editor = "editor_main_" + hashlib.sha1(view_df["idx"].to_numpy().tobytes()).hexdigest()[:12]
+    st.session_state.grade_idx = (chave_editor, view_df["idx"].to_numpy())
 
     edited = st.data_editor(
         view_df,
@@ -552,36 +2412,25 @@ def main():
         },
         use_container_width=True,
         num_rows="dynamic",
-        key="editor_main",
+        key=chave_editor,
         on_change=update_selections,
+        args=(chave_editor,),
     )
 
     # Fallback para seleções manuais
     if isinstance(edited, pd.DataFrame) and not edited.empty:
         current_time = time.time()
         if current_time - st.session_state.last_update_time >= 0.5:
-            previous_selected = st.session_state.selected_idxs.copy()
-            current_view_idxs = set(edited["idx"].astype(int))
-            current_selected = set(edited[edited["selecionado"] == True]["idx"].astype(int))
-            to_remove = previous_selected & current_view_idxs - current_selected
-            new_selected_idxs = (previous_selected - to_remove) | current_selected
-            if new_selected_idxs != st.session_state.selected_idxs:
-                st.session_state.selected_idxs = new_selected_idxs
+            if st.session_state.selected_idxs.aplicar_edicao(edited["idx"], edited["selecionado"]):
                 st.session_state.last_update_time = current_time
                 # Debug: Verificar seleções após fallback
-                # st.write(f"Seleções após fallback: {st.session_state.selected_idxs}")
+                # st.write(f"Seleções após fallback: {len(st.session_state.selected_idxs)}")
 
     st.info(f"Total de itens selecionados: {len(st.session_state.selected_idxs)}")
 
-    # Aplicar ajustes manuais
-    for idx, fat in st.session_state.manual_fat.items():
-        df.loc[df["idx"] == idx, "fator"] = float(fat)
-    df["fator"] = to_float_series(df["fator"], default=float(fator_global))
-    df["fator"] = df["fator"].apply(lambda x: float(fator_global) if pd.isna(x) or x <= 0 else float(x))
-    df["preco_base"] = to_float_series(df["preco_base"], default=0.0)
-    df["preco_de_venda"] = (df["preco_base"].astype(float) * df["fator"].astype(float)).astype(float)
-    for idx, pv in st.session_state.manual_preco_venda.items():
-        df.loc[df["idx"] == idx, "preco_de_venda"] = float(pv)
+    # Aplicar ajustes manuais (vetorizado; os arrays não ficam na sessão, que guarda só os ajustes)
+    with inst.span("precificar", linhas=len(df)):
+        precificar(df, fator_global, st.session_state.manual_fat, st.session_state.manual_preco_venda, produtos=produtos)
 
     # Botões de ação
     cA, cB, cC, cD, cE, cF, cG = st.columns([1,1.2,1.2,1.2,1.6,1.2,1])
@@ -603,13 +2452,9 @@ def main():
     # Forçar atualização
     if forcar_atualizacao:
         if isinstance(edited, pd.DataFrame) and not edited.empty:
-            current_selected = set(edited[edited["selecionado"] == True]["idx"].astype(int))
-            current_view_idxs = set(edited["idx"].astype(int))
-            previous_selected = st.session_state.selected_idxs.copy()
-            to_remove = previous_selected & current_view_idxs - current_selected
-            st.session_state.selected_idxs = (previous_selected - to_remove) | current_selected
+            st.session_state.selected_idxs.aplicar_edicao(edited["idx"], edited["selecionado"])
             st.success(f"Seleções atualizadas: {len(st.session_state.selected_idxs)} itens.")
-            view_df = preparar_view_df(df_filtrado, st.session_state.selected_idxs)
+            view_df = preparar_view_df(janela, st.session_state.selected_idxs)
             st.data_editor(
                 view_df,
                 key=f"editor_main_updated_{datetime.now().timestamp()}",
@@ -634,71 +2479,104 @@ def main():
             st.info("Nenhum item selecionado para pré-visualização. Marque itens na grade.")
         else:
             st.subheader("Pré-visualização da Sugestão")
-            df_sel = df[df["idx"].isin(st.session_state.selected_idxs)].copy()
-            df_sel = ordenar_para_saida(df_sel)
-            preview_lines = []
-            preview_lines.append("Sugestão Carta de Vinhos")
-            if cliente:
-                preview_lines.append(f"Cliente: {cliente}")
-            preview_lines.append("="*70)
-            ordem_geral = 1
-            for tipo in df_sel['tipo'].dropna().unique():
-                tipo_norm = normaliza_tipo(tipo)
-                preview_lines.append(f"\n{tipo_norm.upper()}")
-                for pais in df_sel[df_sel['tipo']==tipo]['pais'].dropna().unique():
-                    preview_lines.append(f"  {str(pais).upper()}")
-                    grupo = df_sel[(df_sel['tipo']==tipo) & (df_sel['pais']==pais)]
-                    for _, row in grupo.iterrows():
-                        desc = row['descricao']
-                        try:
-                            preco = f"R$ {float(row['preco_base']):.2f}"
-                            pvenda = f"R$ {float(row['preco_de_venda']):.2f}"
-                        except Exception:
-                            preco = "R$ -"; pvenda = "R$ -"
-                        try: cod = int(row['cod']) if str(row['cod']).isdigit() else ""
-                        except Exception: cod = str(row.get('cod',""))
-                        regiao = row.get('regiao',"")
-                        preview_lines.append(f"    {ordem_geral:02d} ({cod}) {desc}")
-                        uvas = [str(row.get(f"uva{i}", "")).strip() for i in range(1,4)]
-                        uvas_str = ", ".join([u for u in uvas if u and u.lower()!='nan'])
-                        linha2 = f"      {row.get('pais','')} | {regiao}"
-                        if uvas_str: linha2 += f" | {uvas_str}"
-                        preview_lines.append(linha2)
-                        preview_lines.append(f"      ({preco})  {pvenda}")
-                        if inserir_foto and get_imagem_file(str(row.get('cod',''))):
-                            preview_lines.append("      [COM FOTO]")
-                        ordem_geral += 1
-            preview_lines.append("\n" + "="*70)
-            now = datetime.now().strftime("%d/%m/%Y %H:%M")
-            preview_lines.append(f"Gerado em: {now}")
-            st.code("\n".join(preview_lines))
+            with inst.span("preview") as span:
+                df_sel = df.iloc[produtos.linhas(st.session_state.selected_idxs.indices())]
+                with inst.span("carta", linhas=len(df_sel)):
+                    carta = carta_da_selecao(df_sel, inserir_foto)
+                texto = preview_carta(carta, cliente, inserir_foto)
+                span.anotar(linhas=len(df_sel), bytes=len(texto.encode()))
+            st.code(texto)
 
     if ver_marcados:
         if not st.session_state.selected_idxs:
             st.info("Nenhum item selecionado para visualização. Marque itens na grade.")
         else:
             st.subheader("Itens Marcados")
-            df_sel = df[df["idx"].isin(st.session_state.selected_idxs)].copy()
+            df_sel = df.iloc[produtos.linhas(st.session_state.selected_idxs.indices())].copy()
             df_sel = df_sel[["cod","descricao","pais","regiao","preco_base","preco_de_venda","fator"]].sort_values(["pais","descricao"])
             st.dataframe(df_sel, use_container_width=True)
+            # Mesmos itens em todas as tabelas (só os da planilha; os do diário de cadastros não têm tabelas)
+            pos = df_sel.index.to_numpy()
+            pos = pos[pos < matriz_precos["n"]]
+            if len(pos):
+                st.caption("Preço de venda em cada tabela (preço base da tabela x fator do item)")
+                comparacao = comparar_tabelas(matriz_precos, pos, df["fator"].to_numpy()[pos])
+                comparacao.insert(0, "descricao", df["descricao"].to_numpy()[pos])
+                comparacao.insert(0, "cod", df["cod"].to_numpy()[pos])
+                st.dataframe(comparacao, use_container_width=True, hide_index=True,
+                             column_config={t: st.column_config.NumberColumn(t, format="R$ %.2f") for t in TABELAS_PRECO})
+
+    # PDF/Excel: servidos do cache de artefatos quando itens, preços, cliente, logo e fotos não mudaram
+    def chave_do_artefato(formato):
+        pdf = formato == "pdf"  # O Excel não usa cliente nem logo
+        return chave_artefato(formato, st.session_state.selected_idxs, preco_flag, fator_global,
+                              st.session_state.manual_fat, st.session_state.manual_preco_venda,
+                              cliente if pdf else "", logo_bytes if pdf else None, inserir_foto,
+                              versao_catalogo, catalogo.attrs.get("versao_cadastros") or ())
+
+    def gerar_artefato(formato, renderizar):
+        """Serve do cache ou põe na fila de exportação; a sessão continua livre enquanto o arquivo é gerado."""
+        with inst.span(formato) as span:
+            chave = chave_do_artefato(formato)
+            if cache_artefatos().localizar(chave) is not None:
+                span.anotar(cache=True)
+                st.session_state.setdefault("artefatos_sessao", {})[formato] = chave
+                return
+            df_sel = df.iloc[produtos.linhas(st.session_state.selected_idxs.indices())]
+            with inst.span("carta", linhas=len(df_sel)):
+                carta = carta_da_selecao(df_sel, inserir_foto)
+            anterior = st.session_state.get("exportacoes", {}).get(formato)
+            if anterior is not None and anterior.chave != chave:
+                fila_exportacao().sair(anterior, st.session_state.sessao_id)  # Pedido novo substitui o anterior desta sessão
+            # Cartas grandes vão direto para um arquivo do cache: a sessão não segura o PDF/Excel inteiro na memória
+            destino = cache_artefatos().novo_arquivo(f".{formato}") if carta["total"] >= EXPORTACAO_ARQUIVO_MIN_ITENS else None
+            trabalho = fila_exportacao().enviar(formato, chave, carta["total"], lambda progresso: renderizar(carta, progresso, destino),
+                                               sessao=st.session_state.sessao_id)
+            span.anotar(linhas=len(df_sel), cache=False, fila=trabalho.estado)
+        st.session_state.setdefault("exportacoes", {})[formato] = trabalho
 
     if gerar_pdf_btn:
         if not st.session_state.selected_idxs:
             st.warning("Selecione ao menos um vinho na grade antes de gerar o PDF.")
         else:
-            df_sel = df[df["idx"].isin(st.session_state.selected_idxs)].copy()
-            df_sel = ordenar_para_saida(df_sel)
-            pdf_buffer = gerar_pdf(df_sel, "Sugestão Carta de Vinhos", cliente, inserir_foto, logo_bytes)
-            st.download_button("Baixar PDF", data=pdf_buffer, file_name="sugestao_carta_vinhos.pdf", mime="application/pdf", key="dl_pdf")
+            gerar_artefato("pdf", lambda carta, progresso, destino: gerar_pdf(carta, "Sugestão Carta de Vinhos", cliente, inserir_foto,
+                                                                              logo_bytes, progresso=progresso, destino=destino))
 
     if exportar_excel_btn:
         if not st.session_state.selected_idxs:
             st.warning("Selecione ao menos um vinho na grade antes de exportar para Excel.")
         else:
-            df_sel = df[df["idx"].isin(st.session_state.selected_idxs)].copy()
-            df_sel = ordenar_para_saida(df_sel)
-            xlsx = exportar_excel_like_pdf(df_sel, inserir_foto=inserir_foto)
-            st.download_button("Baixar Excel", data=xlsx, file_name="sugestao_carta_vinhos.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", key="dl_xlsx")
+            gerar_artefato("xlsx", lambda carta, progresso, destino: exportar_excel(carta, inserir_foto=inserir_foto,
+                                                                                    destino=destino, progresso=progresso))
+
+    for aviso in st.session_state.pop("avisos_exportacao", []):
+        st.warning(aviso)
+    if st.session_state.get("exportacoes"):
+        painel_exportacoes()
+
+    # O botão de download continua disponível nos reruns seguintes; se a seleção mudou depois, o rótulo avisa
+    gerados = st.session_state.get("artefatos_sessao", {})
+    for formato, rotulo, arquivo, mime in [
+        ("pdf", "Baixar PDF", "sugestao_carta_vinhos.pdf", "application/pdf"),
+        ("xlsx", "Baixar Excel", "sugestao_carta_vinhos.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
+    ]:
+        chave = gerados.get(formato)
+        if not chave:
+            continue
+        dados = cache_artefatos().localizar(chave)
+        if dados is None:
+            continue
+        if chave != chave_do_artefato(formato):
+            rotulo += " (gerado antes das últimas alterações)"
+        if isinstance(dados, str):
+            # Em disco: lido só quando o botão é clicado, não a cada rerun (Streamlit sem data= adiado: lê agora)
+            try:
+                st.download_button(rotulo, data=lambda chave=chave: cache_artefatos().obter(chave, promover=False) or b"",
+                                   file_name=arquivo, mime=mime, key=f"dl_{formato}")
+                continue
+            except st.errors.StreamlitAPIException:
+                dados = cache_artefatos().obter(chave, promover=False) or b""
+        st.download_button(rotulo, data=dados, file_name=arquivo, mime=mime, key=f"dl_{formato}")
 
     if salvar_sugestao_btn:
         garantir_pastas()
@@ -708,71 +2586,56 @@ def main():
         elif not st.session_state.selected_idxs:
             st.info("Selecione produtos para salvar.")
         else:
-            path = os.path.join(SUGESTOES_DIR, f"{nome}.txt")
-            new_set = set(st.session_state.selected_idxs)
-            if os.path.exists(path):
-                try:
-                    with open(path) as f:
-                        old = [int(x) for x in f.read().strip().split(",") if x]
-                    new_set |= set(old)
-                except Exception as e:
-                    st.warning(f"Erro ao ler sugestão existente '{nome}': {e}")
             try:
-                with open(path, "w") as f:
-                    f.write(",".join(map(str, sorted(list(new_set)))))
-                st.success(f"Sugestão '{nome}' salva (mesclada) em {path}.")
+                total_sug = mesclar_sugestao(nome, st.session_state.selected_idxs.indices().tolist())
+                st.success(f"Sugestão '{nome}' salva (mesclada): {total_sug} itens.")
             except Exception as e:
                 st.error(f"Erro ao salvar sugestão '{nome}': {e}")
 
     # Abas
     st.markdown("---")
-    tab1, tab2 = st.tabs(["Sugestões Salvas", "Cadastro de Vinhos"])
+    tab1, tab2, tab3 = st.tabs(["Sugestões Salvas", "Cadastro de Vinhos", "Análise das Sugestões"])
 
     with tab1:
         garantir_pastas()
-        arquivos = [f for f in os.listdir(SUGESTOES_DIR) if f.endswith(".txt")]
-        sel = st.selectbox("Abrir sugestão", [""] + [a[:-4] for a in arquivos], key="sel_sugestao")
+        sel = st.selectbox("Abrir sugestão", [""] + listar_sugestoes(), key="sel_sugestao")
 
         sugestao_indices = []
         if sel and sel != st.session_state.last_suggestion:
             st.session_state.last_suggestion = sel
-            path = os.path.join(SUGESTOES_DIR, f"{sel}.txt")
-            if os.path.exists(path):
-                try:
-                    with open(path) as f:
-                        sugestao_indices = [int(x) for x in f.read().strip().split(",") if x]
-                    valid_indices = [idx for idx in sugestao_indices if idx in df["idx"].values]
-                    if valid_indices:
-                        previous_selected = st.session_state.selected_idxs.copy()
-                        st.session_state.selected_idxs = set(valid_indices) | previous_selected
-                        # Debug: Verificar seleções após carregar
-                        # st.write(f"Seleções após carregar '{sel}': {st.session_state.selected_idxs}")
-                        st.info(f"Sugestão '{sel}' carregada: {len(valid_indices)} itens válidos mesclados.")
-                        view_df = preparar_view_df(df_filtrado, st.session_state.selected_idxs)
-                        st.data_editor(
-                            view_df,
-                            key=f"editor_sugestao_{sel}_{datetime.now().timestamp()}",
-                            column_config={
-                                "selecionado": st.column_config.CheckboxColumn("SELECIONADO", help="Marque para incluir na sugestão"),
-                                "cod": st.column_config.TextColumn("COD"),
-                                "descricao": st.column_config.TextColumn("DESCRICAO"),
-                                "pais": st.column_config.TextColumn("PAIS"),
-                                "preco_base": st.column_config.NumberColumn("PRECO_BASE", format="R$ %.2f", step=0.01),
-                                "preco_de_venda": st.column_config.NumberColumn("PRECO_VENDA", format="R$ %.2f", step=0.01),
-                                "idx": None,  # Oculta a coluna idx na interface
-                            },
-                            use_container_width=True,
-                            num_rows="dynamic",
-                            on_change=update_selections,
-                        )
-                    else:
-                        st.warning(f"Nenhum item da sugestão '{sel}' corresponde aos índices do DataFrame atual.")
-                except Exception as e:
-                    st.error(f"Erro ao carregar '{sel}': {e}")
+            try:
+                sugestao_indices = ler_sugestao(sel)
+                valid_indices = np.setdiff1d(sugestao_indices, produtos.ausentes(sugestao_indices))
+                if len(valid_indices):
+                    st.session_state.selected_idxs.marcar(valid_indices)
+                    # Debug: Verificar seleções após carregar
+                    # st.write(f"Seleções após carregar '{sel}': {len(st.session_state.selected_idxs)}")
+                    st.info(f"Sugestão '{sel}' carregada: {len(valid_indices)} itens válidos mesclados.")
+                    view_df = preparar_view_df(janela, st.session_state.selected_idxs)
+                    st.data_editor(
+                        view_df,
+                        key=f"editor_sugestao_{sel}_{datetime.now().timestamp()}",
+                        column_config={
+                            "selecionado": st.column_config.CheckboxColumn("SELECIONADO", help="Marque para incluir na sugestão"),
+                            "cod": st.column_config.TextColumn("COD"),
+                            "descricao": st.column_config.TextColumn("DESCRICAO"),
+                            "pais": st.column_config.TextColumn("PAIS"),
+                            "preco_base": st.column_config.NumberColumn("PRECO_BASE", format="R$ %.2f", step=0.01),
+                            "preco_de_venda": st.column_config.NumberColumn("PRECO_VENDA", format="R$ %.2f", step=0.01),
+                            "idx": None,  # Oculta a coluna idx na interface
+                        },
+                        use_container_width=True,
+                        num_rows="dynamic",
+                        on_change=update_selections,
+                    )
+                else:
+                    st.warning(f"Nenhum item da sugestão '{sel}' corresponde aos índices do DataFrame atual.")
+            except Exception as e:
+                st.error(f"Erro ao carregar '{sel}': {e}")
 
         if sugestao_indices:
             st.subheader("Relação da Sugestão")
-            df_rel = df[df["idx"].isin(sugestao_indices)].copy()
+            df_rel = df.iloc[produtos.linhas(sugestao_indices)]
             if not df_rel.empty:
                 df_rel = df_rel[["cod","descricao","pais","regiao","preco_base","fator","preco_de_venda"]].sort_values(["pais","descricao"])
                 st.dataframe(df_rel, use_container_width=True, height=min(500, 50 + 28*len(df_rel)))
@@ -784,7 +2647,7 @@ def main():
             if st.button("Excluir sugestão selecionada", key="btn_excluir_sug"):
                 if sel:
                     try:
-                        os.remove(os.path.join(SUGESTOES_DIR, f"{sel}.txt"))
+                        excluir_sugestao(sel)
                         st.success(f"Sugestão '{sel}' excluída.")
                         st.session_state.last_suggestion = ""
                         st.rerun()
@@ -795,26 +2658,17 @@ def main():
         with coly:
             if st.button("Salvar alterações nesta sugestão (mesclar)", key="btn_merge_sug"):
                 if sel:
-                    path = os.path.join(SUGESTOES_DIR, f"{sel}.txt")
                     try:
-                        old = []
-                        if os.path.exists(path):
-                            with open(path) as f:
-                                old = [int(x) for x in f.read().strip().split(",") if x]
-                        new_set = set(old) | st.session_state.selected_idxs
-                        with open(path, "w") as f:
-                            f.write(",".join(map(str, sorted(list(new_set)))))
-                        st.success(f"Sugestão '{sel}' atualizada (itens mesclados).")
-                        # Debug: Verificar seleções salvas
-                        # st.write(f"Seleções salvas em '{sel}': {new_set}")
+                        total_sug = mesclar_sugestao(sel, st.session_state.selected_idxs.indices().tolist())
+                        st.success(f"Sugestão '{sel}' atualizada (itens mesclados): {total_sug} itens.")
                     except Exception as e:
                         st.error(f"Erro ao salvar '{sel}': {e}")
                 else:
                     st.info("Selecione uma sugestão na lista.")
         with colz:
             if st.button("Limpar seleção atual", key="btn_limpar_sel"):
-                st.session_state.selected_idxs = set()
-                view_df = preparar_view_df(df_filtrado, st.session_state.selected_idxs)
+                st.session_state.selected_idxs.limpar()
+                view_df = preparar_view_df(janela, st.session_state.selected_idxs)
                 st.data_editor(
                     view_df,
                     key=f"editor_main_limpar_{datetime.now().timestamp()}",
@@ -836,7 +2690,8 @@ def main():
                 st.info(f"Total de itens selecionados: {len(st.session_state.selected_idxs)}")
 
     with tab2:
-        st.caption("Cadastrar novo produto (entra apenas na sessão atual; salve no seu Excel depois, se quiser persistir).")
+        st.caption("Cadastrar novo produto (gravado no diário de cadastros ao lado da planilha e visível em todas as sessões; "
+                   "cadastrar de novo o mesmo código substitui o anterior).")
         c1b, c2b, c3b, c4b, c5b, c6b, c7b = st.columns([1,2,1,1,1,1,1.2])
         with c1b:
             new_cod = st.text_input("Código", key="cad_cod")
@@ -857,14 +2712,7 @@ def main():
             try:
                 cod_int = int(float(new_cod)) if new_cod else None
                 pv_calc = new_pv if new_pv > 0 else new_preco * new_fat
-                idx_next = 0
-                if "idx" in df.columns and not df["idx"].isna().all():
-                    try:
-                        idx_next = int(pd.to_numeric(df["idx"], errors="coerce").max()) + 1
-                    except Exception:
-                        idx_next = len(df) + 1
                 novo = {
-                    "idx": idx_next,
                     "cod": cod_int if cod_int is not None else "",
                     "descricao": new_desc,
                     "preco_base": float(new_preco),
@@ -874,11 +2722,77 @@ def main():
                     "regiao": new_regiao,
                     "tipo": "",
                 }
-                st.session_state.cadastrados.append(novo)
-                st.success("Produto cadastrado na sessão atual. Ele já aparece na grade após o recarregamento.")
+                registrar_cadastro(caminho_planilha, novo)
+                st.success("Produto cadastrado. Ele já aparece na grade após o recarregamento.")
                 st.rerun()
             except Exception as e:
                 st.error(f"Erro ao cadastrar: {e}")
 
+        n_cadastros = len(df) - catalogo.attrs.get("n_base", len(df))
+        if n_cadastros:
+            if st.button(f"Compactar cadastros ({n_cadastros})", key="btn_compactar",
+                         help="Reescreve o diário só com os registros vigentes e grava planilha + cadastros no cache Parquet"):
+                try:
+                    compactar_cadastros(caminho_planilha)
+                    st.success("Diário de cadastros compactado.")
+                except Exception as e:
+                    st.error(f"Erro ao compactar: {e}")
+
+    with tab3:
+        # Todas as sugestões numa matriz sugestão x produto, refeita só quando o banco ou o catálogo mudam
+        with inst.span("sugestoes.matriz") as span:
+            chave_sug = versao_catalogo + (catalogo.attrs.get("versao_cadastros"), assinatura_sugestoes()) if versao_catalogo else None
+            matriz_sug = derivado_do_catalogo("sugestoes", chave_sug, lambda: construir_matriz_sugestoes(produtos))
+            span.anotar(sugestoes=len(matriz_sug["nomes"]), itens=len(matriz_sug["posicoes"]))
+        if not matriz_sug["nomes"]:
+            st.info("Nenhuma sugestão salva ainda.")
+        else:
+            frequencia = frequencia_sugestoes(matriz_sug)
+            ausentes = int(matriz_sug["ausentes"].sum())
+            st.caption(f"{len(matriz_sug['nomes'])} sugestões, {len(matriz_sug['posicoes'])} itens, "
+                       f"{int((frequencia > 0).sum())} vinhos distintos"
+                       + (f" ({ausentes} itens fora do catálogo atual)" if ausentes else ""))
+            colunas_item = ["cod", "descricao", "pais", "preco_base", "preco_de_venda"]
+
+            st.subheader("Vinhos mais sugeridos")
+            top = np.argsort(-frequencia, kind="stable")[:20]
+            top = top[frequencia[top] > 0]
+            mais = df.iloc[top][colunas_item].reset_index(drop=True)
+            mais.insert(0, "sugestoes", frequencia[top])
+            st.dataframe(mais, use_container_width=True, hide_index=True)
+
+            st.subheader("Comparar sugestões")
+            ca, cb = st.columns(2)
+            with ca:
+                sug_a = st.selectbox("Sugestão A", [""] + matriz_sug["nomes"], key="analise_a")
+            with cb:
+                sug_b = st.selectbox("Sugestão B", [""] + matriz_sug["nomes"], key="analise_b")
+            if sug_a and sug_b and sug_a != sug_b:
+                itens_a, itens_b = itens_da_sugestao(matriz_sug, sug_a), itens_da_sugestao(matriz_sug, sug_b)
+                comuns = np.intersect1d(itens_a, itens_b, assume_unique=True)
+                st.caption(f"A: {len(itens_a)} itens | B: {len(itens_b)} itens | Em comum: {len(comuns)} | "
+                           f"Só A: {len(itens_a) - len(comuns)} | Só B: {len(itens_b) - len(comuns)}")
+                st.dataframe(df.iloc[comuns][colunas_item], use_container_width=True, hide_index=True)
+            elif sug_a:
+                st.caption(f"Sugestões mais parecidas com '{sug_a}'")
+                st.dataframe(sobreposicao_sugestoes(matriz_sug, sug_a).head(20), use_container_width=True, hide_index=True)
+
+            st.subheader("Sugestões afetadas pela última atualização da planilha")
+            alterados = derivado_do_catalogo("alterados", versao_catalogo, lambda: np.empty(0, dtype=np.int64))
+            if not len(alterados):
+                st.caption("Nenhum item alterado desde o carregamento do catálogo.")
+            else:
+                marcados = np.zeros(len(df), dtype=bool)
+                pos_alt = produtos.posicoes(alterados)
+                marcados[pos_alt[pos_alt >= 0]] = True
+                afetados = contagem_por_sugestao(matriz_sug, marcados)
+                tabela = pd.DataFrame({"sugestao": matriz_sug["nomes"], "itens_alterados": afetados,
+                                       "itens": np.diff(matriz_sug["offsets"])})
+                tabela = tabela[tabela["itens_alterados"] > 0].sort_values("itens_alterados", ascending=False, kind="stable")
+                st.caption(f"{len(alterados)} itens alterados; {len(tabela)} sugestões afetadas.")
+                st.dataframe(tabela, use_container_width=True, hide_index=True)
+
+    painel_desempenho(inst)
+
 if __name__ == "__main__":
     main()
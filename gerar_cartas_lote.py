@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+gerar_cartas_lote.py
+
+Regenera, sem abrir o Streamlit, as cartas (PDF e/ou Excel) de todas as sugestões salvas
+(banco sugestoes/sugestoes.db, ou arquivos .txt no formato antigo passados na linha de comando)
+— útil depois de uma atualização da tabela de preços.
+
+O catálogo é carregado uma vez; cada sugestão vira um modelo de carta (montar_carta) e a
+renderização roda em paralelo num pool de processos. Os arquivos vão para CARTA/<nome>.pdf|.xlsx
+(nome da sugestão reduzido a um nome de arquivo seguro; o original segue como cliente no PDF).
+
+Exemplos:
+    python gerar_cartas_lote.py
+    python gerar_cartas_lote.py "antigas/rest*.txt" --tabela preco15 --fator 1.8 --formato pdf
+    python gerar_cartas_lote.py --sem-foto --jobs 4 --saida /tmp/cartas
+"""
+
+import os
+import re
+import sys
+import glob
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import carta_vinhos_p as cv
+
+TITULO = "Sugestão Carta de Vinhos"
+TABELAS_PRECO = cv.TABELAS_PRECO
+
+
+def nome_arquivo(nome, usados):
+    """Nome de arquivo seguro para a sugestão (sem / nem ..), único entre os já usados nesta execução."""
+    base = re.sub(r"[^\w\- ]", "_", nome).strip(" ") or "sugestao"
+    arquivo, n = base, 2
+    while arquivo.lower() in usados:
+        arquivo, n = f"{base}_{n}", n + 1
+    usados.add(arquivo.lower())
+    return arquivo
+
+
+def _renderizar(tarefa):
+    """Executado no processo filho: desenha a carta nos formatos pedidos e grava os arquivos."""
+    nome, arquivo, carta, formatos, inserir_foto, logo_bytes, saida = tarefa
+    inicio = time.perf_counter()
+    gerados = []
+    for formato in formatos:
+        path = os.path.join(saida, f"{arquivo}.{formato}")
+        if formato == "pdf":
+            cv.gerar_pdf(carta, TITULO, nome, inserir_foto, logo_bytes, destino=path)
+        else:
+            cv.exportar_excel(carta, inserir_foto=inserir_foto, destino=path)
+        gerados.append((path, os.path.getsize(path)))
+    return nome, carta["total"], gerados, time.perf_counter() - inicio
+
+
+def carregar_sugestoes(padroes):
+    """[(nome, [idx, ...])]: do banco de sugestões ou, com padrões glob, dos arquivos .txt antigos."""
+    if not padroes:
+        return [(nome, cv.ler_sugestao(nome)) for nome in cv.listar_sugestoes()]
+    arquivos = []
+    for padrao in padroes:
+        arquivos.extend(glob.glob(padrao))
+    sugestoes = []
+    for path in sorted(set(a for a in arquivos if a.endswith(".txt"))):
+        nome = os.path.splitext(os.path.basename(path))[0]
+        try:
+            sugestoes.append((nome, cv.ler_indices_sugestao(path)))
+        except Exception as e:
+            print(f"[erro] {nome}: {e}")
+    return sugestoes
+
+
+def parse_args(argv=None):
+    ap = argparse.ArgumentParser(description="Gera em lote as cartas das sugestões salvas.")
+    ap.add_argument("sugestoes", nargs="*", help="Arquivos .txt ou padrões glob (padrão: todas as sugestões do banco)")
+    ap.add_argument("--planilha", default="vinhos1.xls", help="Arquivo de dados XLS/XLSX (padrão: vinhos1.xls)")
+    ap.add_argument("--tabela", default="preco1", choices=TABELAS_PRECO, help="Tabela de preço (padrão: preco1)")
+    ap.add_argument("--fator", type=float, default=2.0, help="Fator global (padrão: 2.0)")
+    ap.add_argument("--formato", choices=["pdf", "xlsx", "ambos"], default="ambos")
+    ap.add_argument("--sem-foto", action="store_true", help="Não inserir fotos no PDF/Excel")
+    ap.add_argument("--logo", help="Logo do cliente (png/jpg) aplicado em todas as cartas")
+    ap.add_argument("--saida", default=cv.CARTA_DIR, help="Pasta de destino (padrão: CARTA/)")
+    ap.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Processos em paralelo (padrão: nº de CPUs)")
+    return ap.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sugestoes = carregar_sugestoes(args.sugestoes)
+    if not sugestoes:
+        print("Nenhuma sugestão encontrada.")
+        return 1
+
+    inicio = time.perf_counter()
+    catalogo = cv.carregar_catalogo(args.planilha)
+    if catalogo is None:
+        print(f"Não foi possível carregar {args.planilha}.")
+        return 1
+    # Linhas do diário de cadastros (depois das da planilha) mantêm o preço cadastrado
+    matriz = cv.construir_matriz_precos(cv.catalogo_base(catalogo))
+    df = cv.aplicar_tabela(catalogo.copy(deep=False), matriz, args.tabela, float(args.fator))
+    print(f"Catálogo: {len(df)} itens em {time.perf_counter() - inicio:.2f}s")
+
+    inserir_foto = not args.sem_foto
+    formatos = ["pdf", "xlsx"] if args.formato == "ambos" else [args.formato]
+    logo_bytes = None
+    if args.logo:
+        with open(args.logo, "rb") as f:
+            logo_bytes = f.read()
+    os.makedirs(args.saida, exist_ok=True)
+
+    produtos = cv.IndiceProdutos(df)
+    tarefas = []
+    usados = set()
+    for nome, indices in sugestoes:
+        df_sel = df.iloc[produtos.linhas(indices)]
+        if df_sel.empty:
+            print(f"[vazia] {nome}: nenhum item corresponde ao catálogo atual")
+            continue
+        # O nome original continua como cliente no PDF; o arquivo usa a versão segura
+        tarefas.append((nome, nome_arquivo(nome, usados), cv.montar_carta(df_sel, inserir_foto), formatos,
+                        inserir_foto, logo_bytes, args.saida))
+
+    inicio_render = time.perf_counter()
+    total_itens = total_bytes = erros = 0
+    with ProcessPoolExecutor(max_workers=max(1, args.jobs)) as pool:
+        futuros = [pool.submit(_renderizar, t) for t in tarefas]
+        for futuro in as_completed(futuros):
+            try:
+                nome, itens, gerados, duracao = futuro.result()
+            except Exception as e:
+                erros += 1
+                print(f"[erro] {e}")
+                continue
+            total_itens += itens
+            total_bytes += sum(n for _, n in gerados)
+            print(f"[ok] {nome}: {itens} itens, {', '.join(os.path.basename(p) for p, _ in gerados)} ({duracao:.2f}s)")
+
+    dur = time.perf_counter() - inicio_render
+    feitas = len(tarefas) - erros
+    print(f"{feitas} cartas, {total_itens} itens, {total_bytes / 1024 / 1024:.1f} MB em {dur:.2f}s "
+          f"({feitas / dur if dur else 0:.1f} cartas/s, {total_itens / dur if dur else 0:.0f} itens/s, {args.jobs} processos)")
+    return 1 if erros else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Busca global: o índice invertido cobre todas as colunas de texto da planilha, não só COLUNAS_TEXTO."""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import carta_vinhos_p as cv
+
+
+def _catalogo():
+    return pd.DataFrame({
+        "idx": [0, 1, 2],
+        "cod": ["10", "20", "30"],
+        "descricao": ["VH TINTO A 750 ML", "VH TINTO B 750 ML", "VH BRANCO C 750 ML"],
+        "uva1": ["Merlot", "Syrah", "Chardonnay"],
+        "uva6": ["", "Petit Verdot", ""],
+        "nomeecommerce": ["Vinho Reserva Especial", "", ""],
+        "preco1": [11.5, 21.5, 31.5],
+    })
+
+
+def test_termo_so_em_uva6():
+    indice = cv.construir_indice_busca(_catalogo())
+    assert cv.buscar_linhas(indice, "verdot").tolist() == [1]
+
+
+def test_termo_so_em_nomeecommerce():
+    indice = cv.construir_indice_busca(_catalogo())
+    assert cv.buscar_linhas(indice, "especial").tolist() == [0]
+
+
+def test_precos_fora_do_indice():
+    indice = cv.construir_indice_busca(_catalogo())
+    assert len(cv.buscar_linhas(indice, "11")) == 0
+
+
+def test_mascara_busca_linhas_do_diario():
+    df = _catalogo()
+    indice = cv.construir_indice_busca(df.iloc[:2])
+    mask = cv.mascara_busca(df, "chardonnay", indice)
+    assert np.flatnonzero(mask).tolist() == [2]